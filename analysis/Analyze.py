@@ -2,11 +2,26 @@
 
 OUTPUT_DIR = "../output"    # Relative path to output files
 CLASS_LABEL = "label"       # Name of the attribute you classify for
+LOAD_WORKERS = None         # Processes used to load sessions (None for one per core)
+CACHE_DIR = "parsed_cache"  # Parsed sessions are cached here, inside the output directory
+DESCRIBE_BY = ("label", "user")  # Groups to summarize every feature over (None to skip)
+OUT_OF_CORE = False         # Stream sessions through in chunks instead of loading them all
+EPOCH_OFFSET = 0.5          # Seconds after each color appears that its first window starts
+EPOCH_LENGTH = 2.0          # Seconds per window (None to skip epoching)
+EPOCH_OVERLAP = 0.5         # Fraction of each window shared with the next
 
 import sys
 import os
-import pickle
+import multiprocessing
+import numpy
+import TrainerPath
+TrainerPath.add_trainer_dir()
+import session_io
 import Models
+import Catalog
+from SessionCache import SessionCache
+from ChunkedProcessing import ChunkedDataProcessor
+import Epochs
 
 def convert_output_dir(directory):
     """
@@ -36,38 +51,144 @@ def convert_output_dir(directory):
     return os.path.relpath(directory)
 
 def get_file_list(path):
-    "Returns a list of the files at :path"
+    "Returns a list of the session files at :path"
 
-    file_list = map(lambda x: os.path.join(path, x), os.listdir(path))
-    return file_list
+    return session_io.session_files(path)
 
-def get_file_contents(files):
+def get_file_contents(files, workers=1):
     """
     Takes in a list of files :files and attempts to loop over each file.
-    For each file, it attempts to unpickle the contents, which should have
-    been loaded into the file using the pickle module and the ThinkWave
-    connector.
+    For each file, it attempts to load the session contents, which should have
+    been written either as a single pickle or streamed by the trainer, or
+    converted to columns.  Streamed sessions that were cut short load up to
+    their last full chunk, and columnar sessions are memory mapped.
+
+    :workers sets how many processes decode files in parallel; with None
+    there is one per core.  Contents come back in the same order as :files
+    either way.
+
+    """
+
+    return _map_files(session_io.load_session, files, workers)
+
+def get_sessions(files, label_key=CLASS_LABEL, workers=1):
+    """
+    Loads each file in :files and builds its Models.Session in a worker
+    process, so both decoding and building data points run in parallel.
+    Sessions come back in the same order as :files; sessions without any
+    data are dropped.
+
+    :workers is the number of processes, or None for one per core.
+
+    """
+
+    built = _build_sessions(files, label_key, workers)
+    return [sess for sess in built if sess is not None]
+
+def load_training_set(files, label_key=CLASS_LABEL, workers=1, cache_dir=None):
+    """
+    Builds a Models.TrainingSet over :files, loading them with :workers processes.
+
+    With :cache_dir, parsed sessions are cached there and only files that are
+    new or have changed since the last run are loaded and parsed again.
+
+    """
+
+    if cache_dir is None:
+        sessions = get_sessions(files, label_key, workers)
+    else:
+        cache = SessionCache(cache_dir, label_key)
+        sessions = cache.get_sessions(files, lambda stale: _build_sessions(stale, label_key, workers))
+    return Models.TrainingSet(label_key, None, sessions=sessions)
+
+def get_processor(files, label_key=CLASS_LABEL, workers=1, cache_dir=None, out_of_core=OUT_OF_CORE):
+    """
+    Returns a processor over :files: a ChunkedDataProcessor that streams them
+    with :out_of_core, or else the DataProcessor of a TrainingSet loaded with
+    load_training_set.
+
+    """
+
+    if out_of_core:
+        # Same statistics, computed chunk by chunk; medians are estimates
+        return ChunkedDataProcessor(files, label_key)
+    return load_training_set(files, label_key, workers, cache_dir).processor
+
+def get_epochs(files, label_key=CLASS_LABEL, offset=EPOCH_OFFSET, length=EPOCH_LENGTH,
+        overlap=EPOCH_OVERLAP, workers=1):
+    """
+    Cuts the sessions in :files into stimulus-aligned windows.
+
+    Returns (features, labels, feature_names): a dense n_windows x n_features
+    matrix and the label of each window.  Sessions recorded before the trainer
+    kept receive times are skipped, with a warning for each.
+
+    """
+
+    return Epochs.epoch_sessions(get_file_contents(files, workers), offset, length, overlap, label_key)
+
+def _build_sessions(files, label_key, workers):
+    "Builds a Session (or None, for a file without data) for every file, in order."
+
+    return _map_files(_build_session, [(fn, label_key) for fn in files], workers)
+
+def _build_session(args):
+    "Worker: load one session file and build its Session (None if it is empty)."
+
+    (fn, label_key) = args
+    contents = session_io.load_session(fn)
+    if Models.session_length(contents) == 0:
+        return None
+    return Models.make_session(label_key, contents)
+
+def _map_files(func, items, workers):
+    """
+    Applies :func to every item, in order, spread over :workers processes.
 
     """
 
-    file_contents = []
-    for fn in files:
-        file_contents.append(pickle.load(open(fn, "rb")))
-    return file_contents
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return map(func, items)
+    pool = multiprocessing.Pool(workers)
+    try:
+        # map keeps results in submission order, so output is deterministic
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
 
 if __name__ == '__main__':
     training_file_dir = convert_output_dir(OUTPUT_DIR)
-    training_file_list = get_file_list(training_file_dir)
-    training_data = get_file_contents(training_file_list)
-    training_set = Models.TrainingSet(CLASS_LABEL, training_data)
-    proc = training_set.processor
+    # The catalog lets us load only the sessions a query can touch;
+    # leave out the filters (or use get_file_list) to load everything
+    catalog = Catalog.Catalog(training_file_dir, CLASS_LABEL)
+    training_files = catalog.select(user="michael", label="Blue")
+    cache_dir = os.path.join(training_file_dir, CACHE_DIR)
+    proc = get_processor(training_files, CLASS_LABEL, LOAD_WORKERS, cache_dir)
     # Processor methods:
     # get_point_selection(label=None, user=None, session_number=None, feature=None)
     # get_mean/media/mode/variance/stdev(same as above)
+    # describe(group_by=("label", "user"), features=None)
+    # get_covariance_table(label=None, user=None, session_number=None, feature=None, group_by=("label",))
 #   print(proc.get_point_selection(feature="theta"))
 #   print(training_set.processor.get_points_by_label(label_name="Blue"))
 #   print(training_set.processor.get_point_selection(label="Blue", user="daniel", feature="theta"))
 #   print(proc.get_stdev(feature="theta", label="Blue", user="daniel"))
     print(proc.get_variance(feature="theta", label="Blue", user="michael"))
+    if DESCRIBE_BY is not None:
+        # every feature over every group, so this one covers all the sessions
+        all_proc = get_processor(catalog.select(), CLASS_LABEL, LOAD_WORKERS, cache_dir)
+        print(all_proc.describe(DESCRIBE_BY).format_table())
+    # Summaries the trainer recorded live; these need no session loading at all
+    live_stats = catalog.running_stats(user="michael")
+    if live_stats.stats:
+        print(live_stats.format_report())
+    if EPOCH_LENGTH is not None:
+        (epoch_features, epoch_labels, epoch_names) = get_epochs(training_files, workers=LOAD_WORKERS)
+        print("%d windows x %d features; windows per label: %s" % (epoch_features.shape + (
+                dict(zip(*numpy.unique(epoch_labels, return_counts=True))),)))
     sys.exit(0)
 
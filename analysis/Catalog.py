@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import TrainerPath
+TrainerPath.add_trainer_dir()
+import session_io
+import running_stats
+
+CATALOG_FILENAME = "catalog.json"
+CATALOG_VERSION = 2
+
+
+class Catalog(object):
+    """
+    Index of the session files in an output directory, kept in catalog.json
+    alongside them.
+
+    For every session the catalog records the user, session number, start time,
+    record count, labels present, feature schema and each numeric feature's
+    min/max, along with the file's size and mtime.  Sessions recorded with
+    running statistics also keep them, so per-label summaries over many
+    sessions can be combined from the catalog alone.  refresh() only loads
+    sessions whose files are new or have changed since they were indexed, so
+    keeping the catalog current costs a stat() per file.
+
+    Queries use the catalog to pick out the files they need before loading
+    anything:
+
+    Syntax: catalog = Catalog(output_dir)
+            files = catalog.select(user="michael", label="Blue")
+            contents = catalog.load(user="michael", label="Blue")
+
+    """
+
+    def __init__(self, directory, label_key="label", refresh=True):
+        self.directory = directory
+        self.label_key = label_key
+        self.path = os.path.join(directory, CATALOG_FILENAME)
+        self.entries = {}
+        self.read()
+        if refresh:
+            self.refresh()
+
+    def read(self):
+        "Load the catalog file, if there is a usable one."
+
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                catalog = json.load(f)
+        except ValueError:
+            sys.stderr.write("Unreadable session catalog, rebuilding it\n")
+            return
+        if catalog.get("version") == CATALOG_VERSION:
+            self.entries = catalog["sessions"]
+
+    def write(self):
+        "Save the catalog, replacing the old file only once the new one is complete."
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "sessions": self.entries}, f, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def fingerprint(self, path):
+        """
+        Returns (size, mtime) for a session file.  Columnar sessions are
+        directories, so their metadata file stands in for them.
+
+        """
+
+        if os.path.isdir(path):
+            path = os.path.join(path, session_io.COLUMNS_METADATA_FILENAME)
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime]
+
+    def summarize(self, contents):
+        "Build the catalog entry for a loaded session."
+
+        columns = session_io.session_columns(contents)
+        labels = []
+        if self.label_key in columns:
+            labels = sorted(set(columns[self.label_key].tolist()))
+        ranges = {}
+        for (feature, column) in columns.items():
+            if feature != self.label_key and column.dtype.kind in "iuf" and len(column) > 0:
+                ranges[feature] = [column.min().item(), column.max().item()]
+        return {
+            "user": contents["user"],
+            "session_number": contents["session_number"],
+            "start_time": contents["start_time"],
+            "record_count": len(columns.values()[0]) if columns else 0,
+            "labels": labels,
+            "features": sorted(columns.keys()),
+            "ranges": ranges,
+            "running_stats": contents.get("running_stats"),
+        }
+
+    def summarize_archive(self, path):
+        "Build the catalog entry for a compressed archive from its index alone."
+
+        with session_io.SessionArchive(path) as archive:
+            stats = archive.column_stats()
+            return {
+                "user": archive.metadata["user"],
+                "session_number": archive.metadata["session_number"],
+                "start_time": archive.metadata["start_time"],
+                "record_count": archive.record_count,
+                "labels": stats.get(self.label_key, []),
+                "features": archive.fields,
+                "ranges": dict((f, s) for (f, s) in stats.items()
+                        if f != self.label_key and archive.dtypes[f].kind in "iuf"),
+                "running_stats": archive.metadata.get("running_stats"),
+            }
+
+    def refresh(self):
+        """
+        Bring the catalog up to date with the output directory, indexing new
+        and changed sessions and dropping ones whose files are gone.
+
+        Returns the number of sessions that had to be (re)indexed.
+
+        """
+
+        current = {}
+        changed = 0
+        for path in session_io.session_files(self.directory):
+            name = os.path.basename(path)
+            fingerprint = self.fingerprint(path)
+            entry = self.entries.get(name)
+            if entry is None or entry["fingerprint"] != fingerprint:
+                if path.endswith(session_io.ARCHIVE_EXTENSION):
+                    entry = self.summarize_archive(path)
+                else:
+                    entry = self.summarize(session_io.load_session(path))
+                entry["fingerprint"] = fingerprint
+                changed += 1
+            current[name] = entry
+        removed = len(set(self.entries) - set(current))
+        self.entries = current
+        if changed or removed or not os.path.exists(self.path):
+            self.write()
+        return changed
+
+    def select(self, user=None, session_number=None, label=None):
+        "Returns the paths of the sessions that can contain points matching the query."
+
+        matches = []
+        for name in sorted(self.entries):
+            entry = self.entries[name]
+            if user is not None and entry["user"] != user:
+                continue
+            if session_number is not None and entry["session_number"] != session_number:
+                continue
+            if label is not None and label not in entry["labels"]:
+                continue
+            matches.append(os.path.join(self.directory, name))
+        return matches
+
+    def load(self, user=None, session_number=None, label=None):
+        "Load the contents of only the sessions matching the query."
+
+        return map(session_io.load_session, self.select(user, session_number, label))
+
+    def running_stats(self, user=None, session_number=None, label=None):
+        """
+        Combines the running statistics of the sessions matching the query into
+        one running_stats.LabelStats, without loading any of them.  Sessions
+        recorded before running statistics existed are left out.
+
+        """
+
+        summaries = [self.entries[os.path.basename(path)].get("running_stats")
+                for path in self.select(user, session_number, label)]
+        return running_stats.combine(s for s in summaries if s is not None)
+
+    def get_users(self):
+        return sorted(set(e["user"] for e in self.entries.values()))
+
+    def get_labels(self):
+        return sorted(set(l for e in self.entries.values() for l in e["labels"]))
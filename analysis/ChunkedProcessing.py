@@ -0,0 +1,168 @@
+import numpy
+import TrainerPath
+TrainerPath.add_trainer_dir()
+import session_io
+from running_stats import RunningStats, RunningCovariance
+from DataProcessing import Description, CovarianceTable, DESCRIBE_STATS, DESCRIBE_QUANTILES, NON_FEATURE_COLUMNS
+
+CHUNK_SIZE = 65536  # points held in memory at a time
+
+class ChunkedDataProcessor(object):
+    """
+    Out-of-core counterpart of DataProcessor, for archives too big to load.
+
+    It is instantiated with the session files to analyze:
+    ChunkedDataProcessor(files, label_key="label", chunk_size=CHUNK_SIZE)
+
+    and answers the same statistics queries:
+    get_mean/get_stdev/get_variance/get_median/get_mode(label=None, user=None, session_number=None, feature=None)
+    describe(group_by=("label", "user"), features=None)
+    get_covariance_table(label=None, user=None, session_number=None, feature=None, group_by=("label",))
+
+    Nothing is loaded up front.  Every query streams the files through in
+    chunks of at most chunk_size points and folds each chunk into mergeable
+    partial aggregates per group (running_stats.RunningStats and
+    RunningCovariance), so memory is bounded by the chunk size however big the
+    archive is.  Streamed (.ps), compressed (.pz) and columnar (.cols)
+    sessions are read a chunk at a time; only single pickle (.p) sessions are
+    loaded one whole session at a time.  Selecting by user or session number
+    skips other sessions on their metadata alone.
+
+    Counts, means, variances, min/max and covariances come out the same as
+    DataProcessor's.  Medians and quantiles are estimated from the aggregates'
+    histograms, to within a few percent.
+    """
+
+    def __init__(self, files, label_key="label", chunk_size=CHUNK_SIZE):
+        self.files = list(files)
+        self.label_key = label_key
+        self.chunk_size = chunk_size
+        self.chunks_read = 0
+
+    def iter_chunks(self, user=None, session_number=None, fields=None):
+        "Yields (metadata, columns) for each chunk of the sessions of the given user and session number."
+
+        def select(metadata):
+            return (user is None or metadata["user"] == user) and \
+                    (session_number is None or metadata["session_number"] == session_number)
+
+        for fn in self.files:
+            # sessions are picked out by their metadata before any records are read
+            for (metadata, columns) in session_io.iter_session_chunks(fn, self.chunk_size, fields, select):
+                self.chunks_read += 1
+                yield (metadata, columns)
+
+    def iter_groups(self, group_by, label=None, user=None, session_number=None, fields=None):
+        """
+        Yields (group, columns) for the points of each group in each chunk of the
+        selection, where group is a tuple of values for the keys in :group_by
+        (any of "label", "user" and "session").
+        """
+
+        if fields is not None:
+            fields = list(set(fields) | set([self.label_key]))
+        for (metadata, columns) in self.iter_chunks(user, session_number, fields):
+            labels = columns[self.label_key]
+            if label is not None:
+                keep = labels == label
+                columns = dict((f, column[keep]) for (f, column) in columns.items())
+                labels = labels[keep]
+            if len(labels) == 0:
+                continue
+            if "label" in group_by:
+                (values, label_of) = numpy.unique(labels, return_inverse=True)
+                parts = [(value, label_of == i) for (i, value) in enumerate(values.tolist())]
+            else:
+                parts = [(None, None)]
+            for (value, rows) in parts:
+                keys = {"label": value, "user": metadata["user"], "session": metadata["session_number"]}
+                group = tuple(keys[key] for key in group_by)
+                if rows is None:
+                    yield (group, columns)
+                else:
+                    yield (group, dict((f, column[rows]) for (f, column) in columns.items()))
+
+    def _numeric_features(self, columns):
+        return sorted(f for (f, column) in columns.items()
+                if f != self.label_key and column.dtype.kind in "iuf")
+
+    def _measured_features(self, columns):
+        return [f for f in self._numeric_features(columns) if f not in NON_FEATURE_COLUMNS]
+
+    def aggregate(self, group_by, label=None, user=None, session_number=None, features=None,
+            measured_only=False):
+        """
+        Folds the selection into a RunningStats per group and feature.  Returns
+        (features, {group: {feature: RunningStats}}); features defaults to every
+        numeric one, or with :measured_only to every one but NON_FEATURE_COLUMNS.
+        """
+
+        stats = {}
+        for (group, columns) in self.iter_groups(group_by, label, user, session_number, features):
+            if features is None:
+                features = self._measured_features(columns) if measured_only else self._numeric_features(columns)
+            if group not in stats:
+                stats[group] = dict((f, RunningStats()) for f in features)
+            for f in features:
+                stats[group][f].add(columns[f])
+        return (features or [], stats)
+
+    def _reduce(self, func, label, user, session_number, feature):
+        (features, stats) = self.aggregate((), label or None, user or None,
+                session_number if user else None, [feature] if feature else None)
+        if () not in stats:
+            return dict((f, numpy.nan) for f in features)
+        return dict((f, func(s)) for (f, s) in stats[()].items())
+
+    def get_mean(self, label=None, user=None, session_number=None, feature=None):
+        return self._reduce(lambda s: s.mean, label, user, session_number, feature)
+
+    def get_stdev(self, label=None, user=None, session_number=None, feature=None):
+        return self._reduce(RunningStats.std, label, user, session_number, feature)
+
+    def get_variance(self, label=None, user=None, session_number=None, feature=None):
+        return self._reduce(RunningStats.variance, label, user, session_number, feature)
+
+    def get_median(self, label=None, user=None, session_number=None, feature=None):
+        return self._reduce(lambda s: s.quantile(0.5), label, user, session_number, feature)
+
+    def get_mode(self, label=None, user=None, session_number=None, feature=None):
+        return self._reduce(lambda s: s.mean, label, user, session_number, feature)
+
+    def describe(self, group_by=("label", "user"), features=None, quantiles=DESCRIBE_QUANTILES):
+        "Same table as DataProcessor.describe, built in one streaming pass."
+
+        (features, stats) = self.aggregate(group_by, features=features, measured_only=True)
+        groups = sorted(stats)
+        names = DESCRIBE_STATS + tuple("q%g" % (q * 100) for q in quantiles)
+        values = numpy.empty((len(groups), len(features), len(names)))
+        for (g, group) in enumerate(groups):
+            for (f, feature) in enumerate(features):
+                s = stats[group][feature]
+                values[g, f, :] = [s.count, s.mean, s.std(), s.variance(), s.min, s.max, s.quantile(0.5)] + \
+                        [s.quantile(q) for q in quantiles]
+        return Description(tuple(group_by), groups, features, names, values)
+
+    def get_covariance_table(self, label=None, user=None, session_number=None, feature=None,
+            group_by=("label",)):
+        "Same table as DataProcessor.get_covariance_table, built in one streaming pass."
+
+        if feature is None:
+            features = None
+        else:
+            features = [feature] if isinstance(feature, basestring) else list(feature)
+        accumulators = {}
+        for (group, columns) in self.iter_groups(group_by, label or None, user or None,
+                session_number if user else None, features):
+            if features is None:
+                features = self._measured_features(columns)
+            if group not in accumulators:
+                accumulators[group] = RunningCovariance(len(features))
+            accumulators[group].add(numpy.column_stack([columns[f] for f in features]))
+        features = features or []
+        groups = sorted(accumulators)
+        counts = numpy.array([accumulators[g].count for g in groups])
+        means = numpy.array([accumulators[g].mean for g in groups]).reshape((len(groups), len(features)))
+        covariance = numpy.array([accumulators[g].covariance() for g in groups]).reshape(
+                (len(groups), len(features), len(features)))
+        return CovarianceTable(tuple(group_by), groups, features, counts, means, covariance)
@@ -1,11 +1,18 @@
 import numpy
+from collections import OrderedDict
+
+CACHE_SIZE = 256  # selections and statistics remembered by each DataProcessor
+EMPTY_ROWS = numpy.array([], dtype=numpy.intp)
+DESCRIBE_STATS = ("count", "mean", "std", "var", "min", "max", "median")
+DESCRIBE_QUANTILES = (0.25, 0.75)
+NON_FEATURE_COLUMNS = ("time",)  # numeric columns that aren't measurements
 
 class DataProcessor(object):
     """
     This class is responsible for collecting all of the data and turning it into useful output.
 
     It is instantiated like:
-    DataProcessor(session_list)
+    DataProcessor(featureset, session_list, cache_size=CACHE_SIZE)
 
     and has the following methods:
     get_points_by_label([label_name]) - returns a dictionary of labels with lists of points
@@ -17,15 +24,181 @@ class DataProcessor(object):
     get_mean(label=None, user=None, session=None, feature=None) -- must specify at least one
     get_stdev(label=None, user=None, session=None, feature=None) -- must specify at least one
     get_variance(label=None, user=None, session=None, feature=None)
-    get_covariance_table(label=None, user=None, session=None, feature=None)
+    get_covariance_table(label=None, user=None, session=None, feature=None, group_by=("label",))
     get_median(label=None, user=None, session=None, feature=None)
     get_mode(label=None, user=None, session=None, feature=None)
+    describe(group_by=("label", "user"), features=None) -- every statistic for every feature and group
+    add_sessions(session_list) -- adds more sessions and rebuilds the columns and index
+    cache_info() -- hit/miss counts of the selection and statistics cache
+
+    Points are stored column-wise: one numpy array per feature, plus label, user
+    and session columns holding integer codes into label_vocab, user_vocab and
+    session_vocab.  An inverted index, built once, maps every label, user,
+    session number and (user, session number) pair to the sorted rows holding
+    its points; a selection intersects the index entries it names, starting from
+    the smallest, so it costs time in proportion to the entries and not to the
+    whole dataset.  The statistics are numpy reductions over the selected rows
+    of a feature, so queries never loop over points in Python.  The statistics
+    cover every numeric feature when no feature is given.
+
+    Selected rows and computed statistics are kept in an LRU cache of
+    cache_size entries (0 turns it off), keyed on the normalized selection, so
+    asking again for the same points or statistic costs a dictionary lookup.
+    The cache is emptied whenever sessions are added.
     """
 
-    def __init__(self, featureset, sessions):
+    def __init__(self, featureset, sessions, cache_size=CACHE_SIZE):
         self.featureset = featureset
         self.sessions = sessions
-        self.datapoints = map(lambda x: x.get_data_points(), self.sessions)
+        self.cache = LRUCache(cache_size)
+        self.build_columns()
+        self.build_index()
+
+    def add_sessions(self, sessions):
+        """
+        Adds sessions to the processor, rebuilding the column store and index
+        and dropping everything cached.  Raises ValueError if a session's
+        features do not match the featureset.
+        """
+
+        for sess in sessions:
+            if not self.featureset.check_features(sess.list_features()):
+                raise ValueError("Feature set mismatch in session %s of %s" % (sess.sessnum, sess.username))
+        label_values = set(self.featureset.get_label_values())
+        for sess in sessions:
+            label_values.update(sess.get_label_set())
+        self.featureset.set_label_values(list(label_values))
+        self.sessions.extend(sessions)
+        self.build_columns()
+        self.build_index()
+        self.cache.clear()
+
+    def cache_info(self):
+        "Returns the cache's hits, misses, maxsize and currsize."
+
+        return self.cache.info()
+
+    @property
+    def datapoints(self):
+        "Every session's list of DataPoints, built on demand."
+
+        return [sess.get_data_points() for sess in self.sessions]
+
+    def build_columns(self):
+        """
+        Builds the column store by joining the sessions' columns end to end.
+        session_starts holds the first row of each session.
+        """
+
+        label_key = self.featureset.get_label_key()
+        lengths = [len(sess) for sess in self.sessions]
+        self.num_points = sum(lengths)
+        self.session_starts = numpy.cumsum([0] + lengths)
+        self.columns = {}
+        for feature in self.featureset.get_features():
+            if feature != label_key:
+                self.columns[feature] = _join([sess.get_column(feature) for sess in self.sessions])
+        (self.label_codes, self.label_vocab) = _encode(
+                _join([sess.get_column(label_key) for sess in self.sessions]))
+        (self.user_codes, self.user_vocab) = _encode(
+                numpy.repeat([sess.username for sess in self.sessions], lengths))
+        (self.session_codes, self.session_vocab) = _encode(
+                numpy.repeat([sess.sessnum for sess in self.sessions], lengths))
+
+    def numeric_features(self):
+        "Returns the features whose columns hold numbers."
+
+        return sorted(f for (f, column) in self.columns.items() if column.dtype.kind in "iuf")
+
+    def measured_features(self):
+        "Returns the numeric features that are measurements, i.e. all but NON_FEATURE_COLUMNS."
+
+        return [f for f in self.numeric_features() if f not in NON_FEATURE_COLUMNS]
+
+    def build_index(self):
+        """
+        Builds the inverted index from each label, user, session number and
+        (user, session number) pair to the sorted array of its rows.
+        """
+
+        self.label_index = _group_rows(self.label_codes, self.label_vocab)
+        self.user_index = _group_rows(self.user_codes, self.user_vocab)
+        self.session_index = _group_rows(self.session_codes, self.session_vocab)
+        # session numbers are only unique per user
+        num_sessions = max(len(self.session_vocab), 1)
+        (pair_codes, pairs) = _encode(self.user_codes.astype(numpy.int64) * num_sessions + self.session_codes)
+        pairs = [(self.user_vocab[p // num_sessions], self.session_vocab[p % num_sessions]) for p in pairs]
+        self.user_session_index = _group_rows(pair_codes, pairs)
+
+    def get_rows(self, label=None, user=None, session_number=None):
+        """
+        Returns the sorted rows of the points that match every given value.
+        The array is shared with the cache, so it is read-only.
+        """
+
+        key = ("rows", label, user, session_number)
+        rows = self.cache.get(key)
+        if rows is None:
+            rows = self._find_rows(label, user, session_number)
+            rows.flags.writeable = False
+            self.cache.put(key, rows)
+        return rows
+
+    def _find_rows(self, label, user, session_number):
+        entries = []
+        if label is not None:
+            entries.append(self.label_index.get(label, EMPTY_ROWS))
+        if user is not None and session_number is not None:
+            entries.append(self.user_session_index.get((user, session_number), EMPTY_ROWS))
+        elif user is not None:
+            entries.append(self.user_index.get(user, EMPTY_ROWS))
+        elif session_number is not None:
+            entries.append(self.session_index.get(session_number, EMPTY_ROWS))
+        if not entries:
+            return numpy.arange(self.num_points)
+        entries.sort(key=len)
+        rows = entries[0]
+        for other in entries[1:]:
+            rows = _intersect(rows, other)
+        # a copy, so marking it read-only leaves the index alone
+        return rows.copy()
+
+    def get_mask(self, label=None, user=None, session_number=None):
+        "Returns a boolean array selecting the points that match every given value."
+
+        mask = numpy.zeros(self.num_points, dtype=bool)
+        mask[self.get_rows(label, user, session_number)] = True
+        return mask
+
+    def get_column(self, feature, rows=None):
+        "Returns the values of a feature (or of the label) for the given rows (a row array or mask)."
+
+        if feature == self.featureset.get_label_key():
+            column = numpy.array(self.label_vocab)[self.label_codes] if self.label_vocab \
+                    else numpy.array([])
+        elif feature in self.columns or self.num_points:
+            column = self.columns[feature]
+        else:
+            # with no sessions there are no columns, and every feature is empty
+            column = numpy.array([])
+        return column if rows is None else column[rows]
+
+    def get_points(self, rows):
+        "Returns the DataPoints for rows of the column store, building them on demand."
+
+        owners = numpy.searchsorted(self.session_starts, rows, side="right") - 1
+        return [self.sessions[s].get_data_point(row - self.session_starts[s])
+                for (s, row) in zip(owners.tolist(), numpy.asarray(rows).tolist())]
+
+    def _full_data(self, rows):
+        "Returns the points in :rows as get_full_data() dictionaries."
+
+        return [point.get_full_data() for point in self.get_points(rows)]
+
+    def _expand(self, point_list):
+        "Flattens a list of per-session point lists into get_full_data() dictionaries."
+
+        return [point.get_full_data() for session_points in point_list for point in session_points]
 
     def get_points_by_label(self, label_name=None, point_list=None):
         """
@@ -36,163 +209,395 @@ class DataProcessor(object):
         """
 
         label_key = self.featureset.get_label_key()
-        label_values = self.featureset.get_label_values()
-        matching_points = {}
-        # We are working from the full list
-        if point_list == None:
-            point_list = self.datapoints
-        # Make the point list a list of the full data
-        expanded_points = []
-        for session_points in point_list:
-            map(lambda x: expanded_points.append(x.get_full_data()), session_points)
-        point_list = expanded_points
-#       point_list = map(lambda x: x.get_full_data(), point_list)
         if label_name == None:
-            for label in label_values:
-                matching_points[label] = filter(lambda x: x['data'][label_key] == label, point_list)
+            label_names = self.featureset.get_label_values()
         else:
-            matching_points[label_name] = filter(lambda x: x['data'][label_key] == label_name, point_list)
-        return matching_points
+            label_names = [label_name]
+        if point_list == None:
+            return dict((label, self._full_data(self.get_rows(label=label))) for label in label_names)
+        points = self._expand(point_list)
+        return dict((label, [p for p in points if p['data'][label_key] == label]) for label in label_names)
 
     def get_points_by_user(self, user_name=None, point_list=None):
         """
         Returns all points in the training set with a given username
-        Optionallhy, returns only matching points from a list of points.
+        Optionally, returns only matching points from a list of points.
 
         Returns a dictionary with user_name as the key and a list of matching points as the value.
         """
-        
-        matching_points = {}
-        if point_list == None:
-            point_list = self.datapoints
-        expanded_points = []
-        for session_points in point_list:
-            map(lambda x: expanded_points.append(x.get_full_data()), session_points)
-        point_list = expanded_points
-        if user_name == None:
-            for point in point_list:
-                user = point['user']
-                matching_points[user] = point['data']
-        else:
-            matching_points[user_name] = filter(lambda x: x['user'] == user_name, point_list)
-        return matching_points
 
+        if point_list == None:
+            user_names = self.user_vocab if user_name == None else [user_name]
+            return dict((user, self._full_data(self.get_rows(user=user))) for user in user_names)
+        points = self._expand(point_list)
+        user_names = set(p['user'] for p in points) if user_name == None else [user_name]
+        return dict((user, [p for p in points if p['user'] == user]) for user in user_names)
 
     def get_points_by_session(self, user_name=None, session_num=None, point_list=None):
         """
         Returns all points in the training set with a given username and session number
-        Optionallhy, returns only matching points from a list of points.
+        Optionally, returns only matching points from a list of points.
 
         Returns a dictionary of session numbers with the values as lists of data points
         """
-        
-        matching_points = {}
+
         if session_num == None and user_name == None:
             return self.get_points_by_user(user_name=user_name, point_list=point_list)
-        elif point_list == None:
-            point_list = self.datapoints
-        expanded_points = []
-        for session_points in point_list:
-            map(lambda x: expanded_points.append(x.get_full_data()), session_points)
-        point_list = expanded_points
-        if session_num != None:
-            matching_points[session_num] = filter(lambda x: x['sessnum'] == session_num, point_list)
-        else:
-            if user_name == None: return False
+        if point_list == None:
+            if session_num != None:
+                session_nums = [session_num]
             else:
-                user_points = filter(lambda x: x['user'] == user_name, point_list)
-                for point in user_points:
-                    sessnum = point['sessnum']
-                    if not matching_points[sessnum]: matching_points[sessnum] = []
-                    matching_points[sessnum].append(point)
-        return matching_points
+                session_nums = [num for (user, num) in self.user_session_index if user == user_name]
+            return dict((num, self._full_data(self.get_rows(user=user_name, session_number=num)))
+                    for num in session_nums)
+        points = self._expand(point_list)
+        if user_name != None:
+            points = [p for p in points if p['user'] == user_name]
+        session_nums = set(p['sessnum'] for p in points) if session_num == None else [session_num]
+        return dict((num, [p for p in points if p['sessnum'] == num]) for num in session_nums)
 
     def get_points_by_feature(self, feature_name=None, point_list=None):
         """
-        Returns all points in the training set with a given username
-        Optionallhy, returns only matching points from a list of points.
+        Returns the values of a given feature for all points in the training set
+        Optionally, returns only matching points from a list of points.
 
         Returns a dictionary of matching points indexed by feature_name.
         """
-        
-        matching_points = {}
-        if point_list == None:
-            point_list = self.datapoints
-        expanded_points = []
-        for session_points in point_list:
-            map(lambda x: expanded_points.append(x.get_full_data()), session_points)
-        point_list = expanded_points
+
         if feature_name == None:
-            for point in point_list:
-                for k,v in point['data']:
-                    if not matching_points[k]: matching_points[k] = []
-                    matching_points[k].append(v)
+            feature_names = self.featureset.get_features()
         else:
-            matching_points[feature_name] = map(lambda x: x['data'][feature_name], point_list)
-        return matching_points
+            feature_names = [feature_name]
+        if point_list == None:
+            return dict((f, self.get_column(f).tolist()) for f in feature_names)
+        points = self._expand(point_list)
+        return dict((f, [p['data'][f] for p in points]) for f in feature_names)
 
     def get_point_selection(self, label=None, user=None, session_number=None, feature=None):
-        matching_points = []
-        label_key = self.featureset.get_label_key()
-        point_list = self.datapoints
-        expanded_points = []
-        for session_points in point_list:
-            map(lambda x: expanded_points.append(x), session_points)
-        point_list = expanded_points
-        if label:
-            point_list = filter(lambda x: x.get_feature(label_key) == label, point_list)
-        if user:
-            point_list = filter(lambda x: x.get_user() == user, point_list)
-            if session_number:
-                point_list = filter(lambda x: x.get_sessnum() == session_number, point_list)
+        """
+        Returns the DataPoints matching the given label and user (and session
+        number, which only applies together with a user), or if a feature is
+        given, a dictionary of that feature's name to an array of their values.
+        """
+
+        rows = self.get_rows(label=label or None, user=user or None,
+                session_number=session_number if user else None)
         if feature:
-            point_list = { 
-                    feature : map(lambda x: x.get_feature(feature), point_list),
-                    }
-#       matching_points = map(lambda x: x.get_full_data(), point_list)
-#       return matching_points
-        return point_list
+            return {feature: self.get_column(feature, rows)}
+        return self.get_points(rows)
 
-    def get_mean(self, label=None, user=None, session_number=None, feature=None):
-        points = self.get_point_selection(label=label, user=user, 
-                session_number=session_number, feature=feature)
+    def _reduce(self, name, func, label, user, session_number, feature):
+        """
+        Applies :func to the selected values of :feature, or of every numeric
+        feature.  Results are cached per feature under the statistic's :name.
+        """
+
+        selection = (label or None, user or None, session_number if user else None)
+        rows = None
         output = {}
-        for key, val in points.iteritems():
-            output[key] = numpy.mean(numpy.array(val))
+        for f in ([feature] if feature else self.numeric_features()):
+            key = (name, f) + selection
+            value = self.cache.get(key)
+            if value is None:
+                if rows is None:
+                    rows = self.get_rows(*selection)
+                value = func(self.get_column(f, rows))
+                self.cache.put(key, value)
+            output[f] = value
         return output
 
+    def get_mean(self, label=None, user=None, session_number=None, feature=None):
+        return self._reduce("mean", numpy.mean, label, user, session_number, feature)
+
     def get_stdev(self, label=None, user=None, session_number=None, feature=None):
-        points = self.get_point_selection(label=label, user=user, 
-                session_number=session_number, feature=feature)
-        output = {}
-        for key, val in points.iteritems():
-            output[key] = numpy.std(numpy.array(val))
-        return output
+        return self._reduce("stdev", numpy.std, label, user, session_number, feature)
 
     def get_variance(self, label=None, user=None, session_number=None, feature=None):
-        points = self.get_point_selection(label=label, user=user, 
-                session_number=session_number, feature=feature)
-        output = {}
-        for key, val in points.iteritems():
-            output[key] = numpy.array(val).var()
-        return output
-        # you can use pointarray.var(axis=0 or 1) for column and row variance
-
-#    def get_covariance(label=None, user=None, session=None, feature=None):
-#        points = self.get_point_selection(label, user, session, feature)
+        return self._reduce("variance", numpy.var, label, user, session_number, feature)
 
     def get_median(self, label=None, user=None, session_number=None, feature=None):
-        points = self.get_point_selection(label=label, user=user, 
-                session_number=session_number, feature=feature)
-        output = {}
-        for key, val in points.iteritems():
-            output[key] = numpy.median(numpy.array(val))
-        return output
+        return self._reduce("median", numpy.median, label, user, session_number, feature)
 
     def get_mode(self, label=None, user=None, session_number=None, feature=None):
-        points = self.get_point_selection(label=label, user=user, 
-                session_number=session_number, feature=feature)
-        output = {}
-        for key, val in points.iteritems():
-            output[key] = numpy.mean(numpy.array(val))
-        return output
+        return self._reduce("mode", numpy.mean, label, user, session_number, feature)
+
+    def describe(self, group_by=("label", "user"), features=None, quantiles=DESCRIBE_QUANTILES):
+        """
+        Computes count, mean, std, var, min, max, median and the given quantiles
+        for every feature (default all measured ones) in every group, in one pass
+        per feature.  :group_by names any of "label", "user" and "session"; an
+        empty group_by describes all points as one group.
+
+        Returns a Description.
+        """
+
+        features = self.measured_features() if features is None else list(features)
+        (groups, group_of, counts) = self._group(group_by)
+        starts = numpy.cumsum(counts) - counts
+        ends = starts + counts - 1
+        stats = DESCRIBE_STATS + tuple("q%g" % (q * 100) for q in quantiles)
+        values = numpy.empty((len(groups), len(features), len(stats)))
+        for (f, feature) in enumerate(features):
+            x = self.get_column(feature).astype(numpy.float64)
+            mean = numpy.bincount(group_of, x, len(groups)) / counts
+            deviation = x - mean[group_of]
+            var = numpy.bincount(group_of, deviation * deviation, len(groups)) / counts
+            # sorting by group, then value, puts each group's order statistics side by side
+            ordered = x[numpy.lexsort((x, group_of))]
+            quantile_values = [_quantile(ordered, starts, counts, q) for q in (0.5,) + tuple(quantiles)]
+            values[:, f, :] = numpy.column_stack([counts, mean, numpy.sqrt(var), var,
+                    ordered[starts], ordered[ends]] + quantile_values)
+        return Description(tuple(group_by), groups, features, stats, values)
+
+    def get_covariance_table(self, label=None, user=None, session_number=None, feature=None,
+            group_by=("label",)):
+        """
+        Computes the covariance (and correlation) matrix of the features within
+        every group of the selected points.  :feature is a list of feature
+        names, by default every numeric feature except the time stamp.
+        :group_by is as for describe().
+
+        Each group costs one matrix product over its centred points, so all
+        the feature pairs come out of a single pass.
+
+        Returns a CovarianceTable.
+        """
+
+        rows = self.get_rows(label=label or None, user=user or None,
+                session_number=session_number if user else None)
+        if feature is None:
+            features = self.measured_features()
+        else:
+            features = [feature] if isinstance(feature, basestring) else list(feature)
+        (groups, group_of, counts) = self._group(group_by, rows)
+        points = numpy.empty((len(rows), len(features)))
+        means = numpy.empty((len(groups), len(features)))
+        for (f, name) in enumerate(features):
+            points[:, f] = self.get_column(name, rows)
+            means[:, f] = numpy.bincount(group_of, points[:, f], len(groups)) / counts
+        centred = (points - means[group_of])[numpy.argsort(group_of, kind="mergesort")]
+        covariance = numpy.empty((len(groups), len(features), len(features)))
+        start = 0
+        for (g, count) in enumerate(counts):
+            block = centred[start:start + count]
+            covariance[g] = block.T.dot(block) / count
+            start += count
+        return CovarianceTable(tuple(group_by), groups, features, counts, means, covariance)
+
+    def _group(self, group_by, rows=None):
+        """
+        Splits :rows (default all) by the keys in :group_by.  Returns (groups,
+        group_of, counts): the sorted group value tuples, the index into groups
+        of each row, and the number of rows in each group.
+        """
+
+        keys = {"label": (self.label_codes, self.label_vocab),
+                "user": (self.user_codes, self.user_vocab),
+                "session": (self.session_codes, self.session_vocab)}
+        num_rows = self.num_points if rows is None else len(rows)
+        # combine the group columns into one code per point, one digit per key
+        codes = numpy.zeros(num_rows, dtype=numpy.int64)
+        for key in group_by:
+            key_codes = keys[key][0] if rows is None else keys[key][0][rows]
+            codes = codes * len(keys[key][1]) + key_codes
+        (group_codes, group_of, counts) = numpy.unique(codes, return_inverse=True, return_counts=True)
+        groups = []
+        for code in group_codes.tolist():
+            group = []
+            for key in reversed(group_by):
+                vocab = keys[key][1]
+                group.insert(0, vocab[code % len(vocab)])
+                code //= len(vocab)
+            groups.append(tuple(group))
+        return (groups, group_of, counts)
+
+
+class Description(object):
+    """
+    The table DataProcessor.describe returns.
+
+    values[g, f, s] holds statistic stats[s] of feature features[f] over the
+    points in groups[g], where each group is a tuple of values for the keys in
+    group_by.
+
+    Syntax: description.get("Blue", "daniel")["theta"]["mean"]
+            print(description.format_table())
+    """
+
+    def __init__(self, group_by, groups, features, stats, values):
+        self.group_by = group_by
+        self.groups = groups
+        self.features = features
+        self.stats = stats
+        self.values = values
+
+    def get(self, *group):
+        "Returns {feature: {stat: value}} for one group."
+
+        g = self.groups.index(tuple(group))
+        return dict((feature, dict(zip(self.stats, self.values[g, f].tolist())))
+                for (f, feature) in enumerate(self.features))
+
+    def as_dict(self):
+        "Returns {group: {feature: {stat: value}}} for every group."
+
+        return dict((group, self.get(*group)) for group in self.groups)
+
+    def format_table(self):
+        "Returns the table as text, one line per group and feature."
+
+        header = list(self.group_by) + ["feature"] + list(self.stats)
+        lines = [header]
+        for (g, group) in enumerate(self.groups):
+            for (f, feature) in enumerate(self.features):
+                lines.append([str(v) for v in group] + [feature] +
+                        ["%d" % self.values[g, f, 0]] + ["%.6g" % v for v in self.values[g, f, 1:]])
+        widths = [max(len(line[c]) for line in lines) for c in range(len(header))]
+        return "\n".join("  ".join(cell.rjust(w) for (cell, w) in zip(line, widths)) for line in lines)
+
+    def __str__(self):
+        return self.format_table()
+
+
+class CovarianceTable(object):
+    """
+    The table DataProcessor.get_covariance_table returns.
+
+    covariance[g] is the features x features covariance matrix (normalized by
+    the count, as numpy.var is) of the points in groups[g]; means[g] and
+    counts[g] are their feature means and number.
+
+    Syntax: table.get_covariance("Blue")["theta"]["delta"]
+            table.get_correlation("Blue")["theta"]["delta"]
+            print(table.format_table())
+    """
+
+    def __init__(self, group_by, groups, features, counts, means, covariance):
+        self.group_by = group_by
+        self.groups = groups
+        self.features = features
+        self.counts = counts
+        self.means = means
+        self.covariance = covariance
+
+    def correlation(self):
+        "Returns the correlation matrices, nan where a feature does not vary."
+
+        std = numpy.sqrt(numpy.diagonal(self.covariance, axis1=1, axis2=2))
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return self.covariance / (std[:, :, numpy.newaxis] * std[:, numpy.newaxis, :])
+
+    def _labelled(self, matrices, group):
+        m = matrices[self.groups.index(tuple(group))]
+        return dict((a, dict(zip(self.features, m[i].tolist()))) for (i, a) in enumerate(self.features))
+
+    def get_covariance(self, *group):
+        "Returns {feature: {feature: covariance}} for one group."
+
+        return self._labelled(self.covariance, group)
+
+    def get_correlation(self, *group):
+        "Returns {feature: {feature: correlation}} for one group."
+
+        return self._labelled(self.correlation(), group)
+
+    def format_table(self, correlation=False):
+        "Returns one labelled matrix per group as text."
+
+        matrices = self.correlation() if correlation else self.covariance
+        width = max([len(f) for f in self.features] + [12])
+        cell = "%" + str(width) + "s"
+        out = []
+        for (g, group) in enumerate(self.groups):
+            name = ", ".join("%s=%s" % kv for kv in zip(self.group_by, group)) or "all points"
+            out.append("%s (%d points)" % (name, self.counts[g]))
+            out.append(cell % "" + "".join(" " + cell % f for f in self.features))
+            for (i, feature) in enumerate(self.features):
+                out.append(cell % feature + "".join(" " + cell % ("%.6g" % v) for v in matrices[g, i]))
+        return "\n".join(out)
+
+
+def _encode(values):
+    """
+    Integer-codes a sequence of values.  Returns (codes, vocabulary), where
+    vocabulary is the sorted list of distinct values and codes an int32 array.
+    """
+
+    (vocabulary, codes) = numpy.unique(numpy.asarray(values), return_inverse=True)
+    return (codes.astype(numpy.int32), vocabulary.tolist())
+
+
+def _join(arrays):
+    "Concatenates arrays, allowing for there being none."
+
+    return numpy.concatenate(arrays) if arrays else numpy.array([])
+
+
+def _group_rows(codes, vocabulary):
+    "Returns a dictionary of each vocabulary value to the sorted rows with its code."
+
+    # a stable sort keeps the rows of each code in order
+    order = numpy.argsort(codes, kind="mergesort")
+    bounds = numpy.searchsorted(codes[order], numpy.arange(len(vocabulary) + 1))
+    return dict((value, order[bounds[i]:bounds[i + 1]]) for (i, value) in enumerate(vocabulary))
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that forgets its least recently used entry when full.
+    A maxsize of 0 caches nothing.  get() returns None for missing keys, so
+    None itself can't be cached.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        # reinserting moves the entry to the most recently used end
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def info(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "maxsize": self.maxsize, "currsize": len(self.entries)}
+
+
+def _quantile(ordered, starts, counts, q):
+    """
+    Returns the q-th quantile of each group in :ordered, which holds the groups'
+    sorted values one after the other, interpolating the way numpy.percentile does.
+    """
+
+    position = q * (counts - 1)
+    below = numpy.floor(position).astype(numpy.int64)
+    above = numpy.ceil(position).astype(numpy.int64)
+    low = ordered[starts + below]
+    return low + (ordered[starts + above] - low) * (position - below)
+
+
+def _intersect(rows, other):
+    "Intersects two sorted row arrays in time proportional to the first, which should be the shorter."
+
+    if len(rows) == 0 or len(other) == 0:
+        return EMPTY_ROWS
+    positions = numpy.minimum(numpy.searchsorted(other, rows), len(other) - 1)
+    return rows[other[positions] == rows]
@@ -0,0 +1,172 @@
+import sys
+import numpy
+import TrainerPath
+TrainerPath.add_trainer_dir()
+import session_io
+
+BANDS = ("delta", "theta", "lowAlpha", "highAlpha", "lowBeta", "highBeta", "lowGamma", "highGamma")
+ESENSE = ("attention", "meditation")
+TIME_KEY = "time"
+# Sessions recorded before the trainer kept receive times have times spanning
+# microseconds; sessions whose times span less than this are skipped
+MIN_TIME_SPAN = 1.0  # seconds
+EPSILON = 1e-9
+
+
+def _feature_names():
+    names = ["mean_%s" % b for b in BANDS]
+    names += ["log_%s" % b for b in BANDS]
+    names += ["relative_%s" % b for b in BANDS]
+    names += ["alpha_beta_ratio", "theta_beta_ratio", "theta_alpha_ratio"]
+    names += ["mean_%s" % e for e in ESENSE]
+    return names
+
+FEATURE_NAMES = _feature_names()
+
+
+def stimulus_schedule(contents, label_key="label"):
+    """
+    Returns a session's stimulus schedule as (onsets, durations, labels)
+    arrays, with onsets in seconds from the session's start_time.
+
+    The trainer records the schedule in the session metadata.  For sessions
+    recorded with receive times but without a schedule, every run of points
+    with the same label is taken as one stimulus, lasting from its first
+    point's time to the next run's.
+
+    """
+
+    if contents.get("stimulus_schedule"):
+        (onsets, durations, labels) = zip(*contents["stimulus_schedule"])
+        return (numpy.array(onsets, dtype=numpy.float64), numpy.array(durations, dtype=numpy.float64),
+                numpy.array([str(l) for l in labels]))
+    columns = session_io.session_columns(contents)
+    order = numpy.argsort(columns[TIME_KEY], kind="mergesort")
+    times = numpy.asarray(columns[TIME_KEY], dtype=numpy.float64)[order]
+    labels = columns[label_key][order]
+    if len(times) == 0:
+        return (times, times, labels)
+    firsts = numpy.flatnonzero(numpy.concatenate(([True], labels[1:] != labels[:-1])))
+    onsets = times[firsts]
+    ends = numpy.append(onsets[1:], times[-1])
+    return (onsets, ends - onsets, labels[firsts])
+
+
+def has_session_times(columns):
+    """
+    Tells whether a session's columns hold usable receive times: a time column
+    spanning at least MIN_TIME_SPAN.
+    """
+
+    if TIME_KEY not in columns or len(columns[TIME_KEY]) == 0:
+        return False
+    times = columns[TIME_KEY]
+    return times.max() - times.min() >= MIN_TIME_SPAN
+
+
+def window_bounds(onsets, durations, offset=0.0, length=2.0, overlap=0.0):
+    """
+    Cuts every stimulus into windows of :length seconds, the first starting
+    :offset seconds after its onset and each next one (1 - :overlap) * length
+    later, keeping the windows that end before the stimulus does.
+
+    Returns (starts, ends, stimulus), where stimulus is the index of the
+    stimulus each window belongs to.
+
+    """
+
+    step = length * (1.0 - overlap)
+    if length <= 0 or step <= 0:
+        raise ValueError("windows need a positive length and an overlap below 1")
+    room = durations - offset - length
+    per_stimulus = numpy.where(room >= -EPSILON, numpy.floor(room / step + EPSILON) + 1, 0).astype(numpy.int64)
+    stimulus = numpy.repeat(numpy.arange(len(onsets)), per_stimulus)
+    # each window's position within its stimulus
+    position = numpy.arange(len(stimulus)) - numpy.repeat(numpy.cumsum(per_stimulus) - per_stimulus, per_stimulus)
+    starts = onsets[stimulus] + offset + position * step
+    return (starts, starts + length, stimulus)
+
+
+def window_features(times, columns, starts, ends):
+    """
+    Computes the FEATURE_NAMES vector of every window [start, end) over the
+    points at :times (sorted).
+
+    Every window's points are a contiguous run, found by binary search, so
+    band means come from differences of cumulative sums: the cost is one pass
+    over the points plus one lookup per window, whatever the overlap.
+
+    Returns (features, counts): an n_windows x n_features matrix and the number
+    of points in each window.  Windows without points get rows of nan.
+
+    """
+
+    low = numpy.searchsorted(times, starts, side="left")
+    high = numpy.searchsorted(times, ends, side="left")
+    counts = high - low
+    means = {}
+    for name in BANDS + ESENSE:
+        total = numpy.concatenate(([0.0], numpy.cumsum(columns[name], dtype=numpy.float64)))
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            means[name] = (total[high] - total[low]) / counts
+    power = numpy.column_stack([means[b] for b in BANDS])
+    alpha = means["lowAlpha"] + means["highAlpha"]
+    beta = means["lowBeta"] + means["highBeta"]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        relative = power / power.sum(axis=1)[:, numpy.newaxis]
+        ratios = numpy.column_stack([alpha / beta, means["theta"] / beta, means["theta"] / alpha])
+    features = numpy.column_stack([power, numpy.log10(power + 1.0), relative, ratios] +
+            [means[e] for e in ESENSE])
+    return (features, counts)
+
+
+def epoch_session(contents, offset=0.0, length=2.0, overlap=0.0, label_key="label"):
+    """
+    Cuts one loaded session into stimulus-aligned windows.
+
+    Returns (features, labels): an n_windows x len(FEATURE_NAMES) matrix and the
+    label of the stimulus each window belongs to.  Windows with no points in
+    them are left out.  Sessions without usable receive times (see
+    has_session_times) can't be aligned, so they are skipped with a warning.
+
+    """
+
+    columns = session_io.session_columns(contents)
+    if not columns or len(columns.values()[0]) == 0:
+        return (numpy.empty((0, len(FEATURE_NAMES))), numpy.array([]))
+    if not has_session_times(columns):
+        sys.stderr.write("Skipping session %s of %s for epoching: it has no usable receive times\n"
+                % (contents.get("session_number"), contents.get("user")))
+        return (numpy.empty((0, len(FEATURE_NAMES))), numpy.array([]))
+    times = numpy.asarray(columns[TIME_KEY], dtype=numpy.float64)
+    order = None
+    if len(times) > 1 and (numpy.diff(times) < 0).any():
+        order = numpy.argsort(times, kind="mergesort")
+        times = times[order]
+    sorted_columns = dict((name, columns[name] if order is None else columns[name][order])
+            for name in BANDS + ESENSE)
+    (onsets, durations, labels) = stimulus_schedule(contents, label_key)
+    (starts, ends, stimulus) = window_bounds(onsets, durations, offset, length, overlap)
+    (features, counts) = window_features(times, sorted_columns, starts, ends)
+    keep = counts > 0
+    return (features[keep], labels[stimulus][keep])
+
+
+def epoch_sessions(contents_list, offset=0.0, length=2.0, overlap=0.0, label_key="label"):
+    """
+    Epochs every session in :contents_list (as session_io.load_session returns
+    them) and stacks the results.
+
+    Returns (features, labels, feature_names), ready for a classifier.
+
+    """
+
+    features = []
+    labels = []
+    for contents in contents_list:
+        (f, l) = epoch_session(contents, offset, length, overlap, label_key)
+        features.append(f)
+        labels.append(l)
+    if not features:
+        return (numpy.empty((0, len(FEATURE_NAMES))), numpy.array([]), FEATURE_NAMES)
+    return (numpy.concatenate(features), numpy.concatenate(labels), FEATURE_NAMES)
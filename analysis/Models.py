@@ -1,5 +1,5 @@
-import random
 import sys
+import numpy
 import DataProcessing
 
 class Session(object):
@@ -12,63 +12,93 @@ class Session(object):
 
     Syntax: sessobj = Session(session_number, start_time, username, label_key, session_data)
     Note that session_data should be passed in as list of all of the data points
-    
+    Alternatively pass columns={feature: array} instead of session_data.
+
+    The session keeps its points as one numpy array per feature.  DataPoint
+    objects are only built when they are asked for, through get_data_points(),
+    get_data_point(i) or iterating over the session, and are not kept.
+
     """
 
-    def __init__(self, sessnum, start_time, username, label_key, session_data):
+    def __init__(self, sessnum, start_time, username, label_key, session_data=None, columns=None):
         self.sessnum = sessnum
         self.start_time = start_time
         self.username = username
-        self.data = session_data
+        if columns is None:
+            columns = records_to_columns(session_data or [])
+        self.columns = columns
+        self.num_points = len(columns.values()[0]) if columns else 0
         self.features = self.get_features()
         self.label_key = label_key
-        self.make_data_points()
+
+    def __len__(self):
+        return self.num_points
+
+    def __iter__(self):
+        return iter(self.get_data_points())
+
+    @property
+    def data(self):
+        "The session's records as a list of dictionaries, built on demand."
+
+        fields = list(self.columns.keys())
+        values = [self.columns[f].tolist() for f in fields]
+        return [dict(zip(fields, row)) for row in zip(*values)]
+
+    @property
+    def datapoints(self):
+        return self.get_data_points()
 
     def get_features(self):
         """
-        Get the list of feature keys for a random data point in the session.
+        Get the list of feature keys in the session.
 
-        Returns the feature keys of the randomly selected entry.
+        Returns the names of the session's columns.
         
         """
 
-        num_entries = len(self.data)
-        # Choose a random data point
-        entry_num = random.randint(1, num_entries) - 1
-        target_entry = self.data[entry_num]
-        return target_entry.keys()
+        return sorted(self.columns.keys())
 
     def list_features(self):
         "Returns a list of all of the feature KEYS in this session file"
 
         return self.features
 
+    def get_column(self, featurename):
+        "Returns the array of values of a feature, one per data point"
+
+        return self.columns[featurename]
+
     def get_value_by_feature(self, featurename):
         "Returns a list of all data points for a given feature"
 
-        if self.feature_map is not None:
-            return self.feature_map[featurename]
+        return self.columns[featurename].tolist()
 
     def make_data_points(self):
         "Creates a list of all data points recorded in this session"
 
-        self.datapoints = []
-        for datapoint in self.data:
-            point_user = self.username
-            point_sessnum = self.sessnum
-            point = DataPoint(point_user, point_sessnum,  datapoint)
-            self.datapoints.append(point)
+        return [DataPoint(self.username, self.sessnum, record) for record in self.data]
 
     def get_data_points(self):
         "Returns all of the session's data points"
 
-        return self.datapoints
+        return self.make_data_points()
+
+    def get_data_point(self, index):
+        "Returns the data point at a position in the session"
+
+        record = dict((f, column[index].item()) for (f, column) in self.columns.items())
+        return DataPoint(self.username, self.sessnum, record)
 
     def get_label_keys(self):
         "Returns all of the values for the label category"
 
-        labels = map(lambda x: x.get_feature(self.label_key), self.datapoints)
-        return labels
+        return self.columns[self.label_key].tolist()
+
+    def get_label_set(self):
+        "Returns the distinct values of the label category"
+
+        return numpy.unique(self.columns[self.label_key]).tolist()
 
 
 class Featureset(object):
@@ -222,7 +252,17 @@ class TrainingSet(object):
     """
 
 
-    def __init__(self, keyname, training_data):
+    @classmethod
+    def from_catalog(cls, keyname, catalog, user=None, session_number=None, label=None):
+        """
+        Build a TrainingSet from only the sessions in a Catalog that can contain
+        points for the given user, session number and label.
+
+        """
+
+        return cls(keyname, catalog.load(user=user, session_number=session_number, label=label))
+
+    def __init__(self, keyname, training_data, sessions=None):
         """
         Initialize the TrainingSet class.
 
@@ -234,6 +274,8 @@ class TrainingSet(object):
         make predictions.
         :training_data represents the file contents of the saved session
         files, passed to the initializer as a list of file contents.
+        :sessions optionally passes in Session objects that were already built
+        (e.g. by worker processes), in which case training_data is not parsed.
 
         """
 
@@ -242,38 +284,43 @@ class TrainingSet(object):
         self.classify_on_key = keyname
         self.training_data = training_data
         # Kick off the training session by actually creating session objects in self.sessions
-        if self.parse() is True:
+        if self.parse(sessions) is True:
             # Now create Data Processing objects and pass all of the sessions and features
             self.processor = DataProcessing.DataProcessor(self.featureset, self.sessions)
             # Do more things with the DataProcessor...
         else:
             sys.stderr.write("Error parsing data: exiting...")
 
-    def parse(self):
+    def parse(self, prebuilt_sessions=None):
         """
         Takes raw training data and turns it into modular sessions for manipulation
+        If :prebuilt_sessions is given, those sessions are checked and used instead.
 
         Returns :True if it is successful, otherwise returns :False.
 
         """
 
+        if prebuilt_sessions is None:
+            # FileContents will contain the following keys:
+            # start_time, user, session_number, data
+            # data['keyname'] returns the value of the key in that datapoint
+            # Sessions interrupted before any data was recorded are skipped
+            prebuilt_sessions = (self.make_session(filecontents)
+                    for filecontents in self.training_data
+                    if self.session_length(filecontents) > 0)
         sessions = []
         # Make the label values a set to automatically prune duplicates
         label_vals = set() 
-        # Loop over each session file in the training data, ultimately filling
+        # Loop over each session in the training data, ultimately filling
         # an array with session objects for later analysis
-        for filecontents in self.training_data:
-            # FileContents will contain the following keys:
-            # start_time, user, session_number, data
-            # data['keyname'] returns the value of the key in that datapoint
-            sess = self.make_session(filecontents)
+        for sess in prebuilt_sessions:
             # Generate a list of features from the session, make sure they
             # are the same as any previous features we recorded for this data
             features = sess.list_features()
             if not self.featureset.check_features(features):
                 sys.stderr.write("Feature set mismatch!")
                 return False
-            map(lambda x: label_vals.add(x), sess.get_label_keys())
+            label_vals.update(sess.get_label_set())
             sessions.append(sess)
         # Move sessions to the class instance, set_label_vals on
         # self.featureset to have a list of possible values for your label key
@@ -281,6 +328,11 @@ class TrainingSet(object):
         self.featureset.set_label_values(list(label_vals))
         return True
 
+    def session_length(self, data):
+        "Returns the number of records in the raw contents of a session file."
+
+        return session_length(data)
+
     def make_session(self, data):
         """
         Instantiate a session object using raw data.  Return that object.
@@ -290,10 +342,47 @@ class TrainingSet(object):
 
         """
 
-        start_time = data['start_time']
-        username = data['user']
-        sessnum = data['session_number']
-        sess_data = data['data']
-        new_session = Session(sessnum, start_time, username, self.classify_on_key, sess_data)
-        return new_session
+        return make_session(self.classify_on_key, data)
+
+
+def session_length(data):
+    "Returns the number of records in the raw contents of a session file."
+
+    if 'columns' in data:
+        return len(data['columns'].values()[0]) if data['columns'] else 0
+    return len(data['data'])
+
+
+def make_session(label_key, data):
+    """
+    Instantiate a session object from the raw contents of a session file.
+
+    This is a plain function so session loading can be farmed out to worker
+    processes; TrainingSet.make_session calls it with its own label key.
+
+    """
 
+    start_time = data['start_time']
+    username = data['user']
+    sessnum = data['session_number']
+    if 'columns' in data:
+        # Columnar sessions hold one array per field already; copying them
+        # out of any memory map lets the session outlive the file
+        columns = dict((f, numpy.array(c)) for (f, c) in data['columns'].items())
+    elif 'fields' in data:
+        # Newer session files store each record as a tuple, with the
+        # field names listed once under 'fields'
+        values = zip(*data['data'])
+        columns = dict((f, numpy.array(v)) for (f, v) in zip(data['fields'], values))
+    else:
+        columns = records_to_columns(data['data'])
+    new_session = Session(sessnum, start_time, username, label_key, columns=columns)
+    return new_session
+
+
+def records_to_columns(records):
+    "Turns a list of record dictionaries into a dictionary of feature name to array."
+
+    if not records:
+        return {}
+    return dict((f, numpy.array([r[f] for r in records])) for f in records[0].keys())
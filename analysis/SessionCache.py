@@ -0,0 +1,156 @@
+import os
+import hashlib
+import cPickle
+
+CACHE_VERSION = 2
+CACHE_EXTENSION = ".cache"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_hash(path):
+    """
+    Returns a SHA-1 of a session file's contents.  Columnar sessions are
+    directories, so every file in them is hashed in name order.
+
+    """
+
+    if os.path.isdir(path):
+        paths = [os.path.join(path, fn) for fn in sorted(os.listdir(path))]
+    else:
+        paths = [path]
+    digest = hashlib.sha1()
+    for p in paths:
+        with open(p, "rb") as f:
+            block = f.read(HASH_BLOCK_SIZE)
+            while block:
+                digest.update(block)
+                block = f.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def file_stat(path):
+    "Returns [size, mtime] for a session file, summed over a directory's files."
+
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(path, fn)) for fn in os.listdir(path)]
+        return [sum(s.st_size for s in stats), max([s.st_mtime for s in stats] or [0])]
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime]
+
+
+class SessionCache(object):
+    """
+    On-disk cache of parsed Models.Session objects, one entry per session file.
+
+    Each entry is keyed on the session file's path and stores its size, mtime
+    and content hash.  A file whose size and mtime are unchanged is trusted
+    without rereading it.  A file whose stat changed is hashed, and only if
+    the hash differs too is the session parsed again.  New files are parsed
+    and added, and entries for files that no longer exist are removed, so an
+    archive that grows by one session per run only pays to parse that one.
+
+    Syntax: cache = SessionCache(cache_dir, label_key)
+            sessions = cache.get_sessions(files, build_func)
+    where build_func takes a list of files and returns a list of Sessions (or
+    None for files without data) in the same order.
+
+    """
+
+    def __init__(self, directory, label_key):
+        self.directory = directory
+        self.label_key = label_key
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def entry_path(self, session_path):
+        name = "%s.%s%s" % (os.path.basename(session_path.rstrip(os.sep)), self.label_key, CACHE_EXTENSION)
+        return os.path.join(self.directory, name)
+
+    def read_key(self, session_path):
+        "Returns the key stored in a cache entry without loading its session."
+
+        try:
+            with open(self.entry_path(session_path), "rb") as f:
+                return cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+            return None
+
+    def read_session(self, session_path):
+        with open(self.entry_path(session_path), "rb") as f:
+            cPickle.load(f)
+            return cPickle.load(f)
+
+    def write(self, session_path, key, session):
+        "Write an entry: its key first, so it can be checked cheaply, then the session."
+
+        path = self.entry_path(session_path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            cPickle.dump(key, f, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(session, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+    def is_current(self, session_path, key):
+        """
+        Checks a cache entry's key against the session file.  Returns
+        (current, key), where key is refreshed if the file had to be hashed.
+
+        """
+
+        stat = file_stat(session_path)
+        if key is not None and key["version"] == CACHE_VERSION \
+                and key["path"] == os.path.abspath(session_path) and key["stat"] == stat:
+            return (True, key)
+        new_key = {"version": CACHE_VERSION, "path": os.path.abspath(session_path),
+                "stat": stat, "hash": file_hash(session_path)}
+        current = key is not None and key.get("version") == CACHE_VERSION \
+                and key["path"] == new_key["path"] and key["hash"] == new_key["hash"]
+        return (current, new_key)
+
+    def get_sessions(self, files, build_func):
+        """
+        Returns the Sessions for :files, in order, taking them from the cache
+        where it is current and calling :build_func for the rest.  Sessions
+        without data are dropped, as they are when loading without a cache.
+
+        """
+
+        results = [None] * len(files)
+        stale = []
+        for (idx, fn) in enumerate(files):
+            old_key = self.read_key(fn)
+            (current, key) = self.is_current(fn, old_key)
+            if current:
+                try:
+                    results[idx] = self.read_session(fn)
+                    self.hits += 1
+                    if key is not old_key:
+                        # same contents, new stat: remember it so we skip hashing next time
+                        self.write(fn, key, results[idx])
+                    continue
+                except (IOError, EOFError, cPickle.UnpicklingError, ValueError):
+                    pass
+            stale.append((idx, fn, key))
+        if stale:
+            self.misses += len(stale)
+            built = build_func([fn for (idx, fn, key) in stale])
+            for ((idx, fn, key), sess) in zip(stale, built):
+                self.write(fn, key, sess)
+                results[idx] = sess
+        self.prune(files)
+        return [sess for sess in results if sess is not None]
+
+    def prune(self, files):
+        "Remove entries for session files that are no longer in :files' directories."
+
+        wanted = set(os.path.basename(self.entry_path(fn)) for fn in files)
+        directories = set(os.path.dirname(os.path.abspath(fn)) for fn in files)
+        suffix = ".%s%s" % (self.label_key, CACHE_EXTENSION)
+        for name in os.listdir(self.directory):
+            if not name.endswith(suffix) or name in wanted:
+                continue
+            session_name = name[:-len(suffix)]
+            if not any(os.path.exists(os.path.join(d, session_name)) for d in directories):
+                os.remove(os.path.join(self.directory, name))
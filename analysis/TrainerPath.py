@@ -0,0 +1,15 @@
+import os
+import sys
+
+# The session file readers and running statistics are shared with the trainer, one directory up
+TRAINER_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+def add_trainer_dir():
+    """
+    Puts the trainer directory on sys.path, so its session_io and
+    running_stats modules can be imported.  Modules that need them call this
+    before importing them.
+    """
+
+    if TRAINER_DIR not in sys.path:
+        sys.path.append(TRAINER_DIR)
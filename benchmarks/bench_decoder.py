@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_decoder.py
+
+Compares eeg._decode_frame, which recognises the connector's fixed frame shapes,
+against plain json decoding, on frames built from the recorded sessions in
+output/ plus raw-mode rawEeg frames. Also checks both paths agree.
+
+usage: python benchmarks/bench_decoder.py [repeats]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import eeg
+import thinkgear_sim
+
+REPEATS = 20
+
+
+def _frames():
+	values = thinkgear_sim.load_recorded_values(thinkgear_sim.recorded_session_files())
+	sample_frames = [thinkgear_sim._frame(thinkgear_sim._sample_message(v)).rstrip(eeg.HEADSET_JSON_SEPARATOR) for v in values]
+	raw_frames = thinkgear_sim._raw_frames(len(sample_frames) * eeg.RAW_SAMPLE_RATE).split(eeg.HEADSET_JSON_SEPARATOR)[:-1]
+	return (sample_frames, raw_frames)
+
+
+def run(decode, frames, repeats):
+	start = time.time()
+	for i in xrange(repeats):
+		for f in frames:
+			decode(f)
+	return len(frames) * repeats / (time.time() - start)
+
+
+def main():
+	repeats = int(sys.argv[1]) if len(sys.argv) > 1 else REPEATS
+	(sample_frames, raw_frames) = _frames()
+	for f in sample_frames[:50] + raw_frames[:50]:
+		assert eeg._decode_frame(f) == eeg._decode_json_frame(f), f
+	for (name, frames, reps) in (('sample', sample_frames, repeats * 50), ('rawEeg', raw_frames, max(repeats / 10, 1))):
+		json_rate = run(eeg._decode_json_frame, frames, reps)
+		fast_rate = run(eeg._decode_frame, frames, reps)
+		print '%-7s json %9.0f frames/s   fast %9.0f frames/s   (%.1fx)' % (name, json_rate, fast_rate, fast_rate / json_rate)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_frame_reader.py
+
+Measures how many messages per second eeg._event_stream can pull off of a
+local fake ThinkGear connector, compared against the old byte-at-a-time reader.
+
+usage: python benchmarks/bench_frame_reader.py [num_messages]
+"""
+
+import os
+import sys
+import json
+import time
+from socket import *
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import eeg
+
+NUM_MESSAGES = 50000
+SAMPLE_MESSAGE = {
+	'eSense': {'attention': 53, 'meditation': 61},
+	'eegPower': {'delta': 286294, 'theta': 203239, 'lowAlpha': 55784, 'highAlpha': 16573,
+		'lowBeta': 15923, 'highBeta': 17525, 'lowGamma': 11976, 'highGamma': 19961},
+	'poorSignalLevel': 0}
+
+
+def _fake_connector(server_socket, num_messages):
+	"""Accepts one client, swallows its config message and sends num_messages frames."""
+	conn, addr = server_socket.accept()
+	conn.recv(1024)
+	frame = json.dumps(SAMPLE_MESSAGE) + eeg.HEADSET_JSON_SEPARATOR
+	batch = frame * 1000
+	sent = 0
+	while sent < num_messages:
+		n = min(1000, num_messages - sent)
+		conn.sendall(batch if n == 1000 else frame * n)
+		sent += n
+	conn.close()
+	server_socket.close()
+
+
+def _start_fake_connector(num_messages):
+	ss = socket(AF_INET, SOCK_STREAM)
+	ss.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+	ss.bind(('127.0.0.1', 0))
+	ss.listen(1)
+	t = Thread(target=_fake_connector, args=(ss, num_messages))
+	t.daemon = True
+	t.start()
+	return ss.getsockname()[1]
+
+
+def _legacy_event_stream(shutdown_func, host, port):
+	"""The original one-recv-per-byte reader, kept here for comparison."""
+	soc = eeg._create_and_connect_socket(host, port)
+	while not shutdown_func():
+		temp_json = ''
+		cur_char = soc.recv(1)
+		if not cur_char:
+			break
+		while cur_char != eeg.HEADSET_JSON_SEPARATOR:
+			temp_json += cur_char
+			cur_char = soc.recv(1)
+		data = json.loads(temp_json)
+		if eeg.eSense in data and eeg.eegPower in data:
+			yield dict(zip(eeg.brain_parameters, eeg._extract_tuple(data)))
+		else:
+			yield data
+	soc.close()
+
+
+def run(stream_func, num_messages):
+	port = _start_fake_connector(num_messages)
+	count = 0
+	start = time.time()
+	for msg in stream_func(lambda: False, '127.0.0.1', port):
+		count += 1
+		if count == num_messages:
+			break
+	elapsed = time.time() - start
+	return (count, elapsed)
+
+
+def main():
+	num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else NUM_MESSAGES
+	for (name, func) in (('byte reader', _legacy_event_stream), ('chunked reader', eeg._event_stream)):
+		(count, elapsed) = run(func, num_messages)
+		print '%-15s %8d messages in %6.2fs  %10.0f msg/s' % (name, count, elapsed, count / elapsed)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+bench_samples.py
+
+Compares eeg.Sample records against the old per-message dictionaries for a
+long recording: bytes held per stored record and how fast samples can be
+built, tagged and turned into session output.
+
+usage: python benchmarks/bench_samples.py [hours]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import eeg
+
+HOURS = 4
+SAMPLE_RATE = 1 # eSense/eegPower summaries arrive about once a second
+
+
+def _random_values():
+	return tuple(random.randint(0, 2 ** 20) for p in eeg.brain_parameters[:8]) + (0, random.randint(0, 100), random.randint(0, 100))
+
+
+def _record_size(record):
+	"""Bytes held by one stored record, not counting small ints shared by the interpreter."""
+	size = sys.getsizeof(record)
+	if isinstance(record, dict):
+		values = record.values()
+	else:
+		values = record.as_tuple()
+	for v in values:
+		if isinstance(v, float) or (isinstance(v, int) and not -5 <= v <= 256):
+			size += sys.getsizeof(v)
+	return size
+
+
+def run_dicts(values):
+	start = time.time()
+	records = []
+	for v in values:
+		d = dict(zip(eeg.brain_parameters, v))
+		records.append(dict([('time', time.time() - start), ('label', 'Blue')] + d.items()))
+	return (time.time() - start, records)
+
+
+def run_samples(values):
+	start = time.time()
+	records = []
+	for v in values:
+		s = eeg.Sample(v)
+		s.time = time.time() - start
+		s.label = 'Blue'
+		records.append(s)
+	output = [s.as_tuple() for s in records]
+	return (time.time() - start, records)
+
+
+def main():
+	hours = float(sys.argv[1]) if len(sys.argv) > 1 else HOURS
+	n = int(hours * 3600 * SAMPLE_RATE)
+	values = [_random_values() for i in xrange(n)]
+	print '%d records (%.1f hours at %d Hz)' % (n, hours, SAMPLE_RATE)
+	for (name, func) in (('dicts', run_dicts), ('Sample', run_samples)):
+		(elapsed, records) = func(values)
+		per_record = sum(_record_size(r) for r in records[:1000]) / 1000.0
+		print '%-7s %6d bytes/record  %7.1f MB total  %9.0f records/s' % (name, per_record, per_record * n / 2 ** 20, n / elapsed)
+
+if __name__ == '__main__':
+	main()
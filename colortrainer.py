@@ -6,10 +6,14 @@ import collections
 from collections import defaultdict as ddict
 import os
 import pickle
+import numpy
 
 import utils
-from eeg import MindStream
+import latency
+from running_stats import LabelStats
+from eeg import MindStream, Sample, DROP_OLDEST, BLOCK_TIME, brain_parameters
 from scene_management import Scene, SceneManager, QUIT_SCENE_MANAGER_KEYWORD
+from session_io import SessionWriter, STREAM_EXTENSION
 
 # constants
 white = (255,255,255)
@@ -31,9 +35,12 @@ APP_TITLE = 'Color Trainer'
 
 
 TRAINING_INTERVAL = 4 # seconds
+MAX_QUEUED_MESSAGES = 1024 # headset messages kept while nothing is draining the stream
+MEASURE_LATENCY = False # time each hop from socket read to stored record and report at exit
 NUM_ROUNDS = 2
 scenes = (CONNECTING, INSTRUCTION) = ('Connecting', 'Instruction')
 labels = {red:'Red', green:'Green', blue:'Blue'}
+LABEL_COLUMN = 'label'
 # UI constants
 CONNECTING_MESSAGE = 'Connecting to MindWave Headset...'
 INSTRUCTION_MESSAGE = 'Once training starts, the window will randomly shift between different colors. When a given color is displayed, think about that color as hard as you can. The training program is separated into rounds, and in each round every color will be displayed once but in random order. Good luck, and stay focused.'
@@ -41,13 +48,29 @@ INSTRUCTION_DISPLAY_TIME = 5 # seconds
 # persistence constants
 CONFIG_OBJECT_FILENAME = 'user_id.p'
 DATA_OUTPUT_DIRECTORY = 'output'
+SESSION_CHUNK_SIZE = 64 # records written to the session file at a time
+SESSION_FSYNC_INTERVAL = 5 # seconds between forcing the session file to disk
 
-def tagData(data, label, starting_time):
-	if not data:
+def tagData(block, label, starting_time):
+	"""
+	Tags a columnar block from MindStream.drainColumns: adds a label column and
+	makes the receive times relative to starting_time. label is either one label
+	for the whole block or an array with one per sample. Samples received before
+	starting_time are dropped.
+	"""
+	if block is None:
 		return None
-	filtered_data = filter(lambda x: len(x.keys()) > 1, data)
-	tagged_data = [ dict( [ ('time', time.time() - starting_time), ('label', label) ] + d.items() ) for d in filtered_data ]
-	return tagged_data
+	keep = block[BLOCK_TIME] >= starting_time
+	if not keep.all():
+		block = dict((k, v[keep]) for (k, v) in block.items())
+		if isinstance(label, numpy.ndarray):
+			label = label[keep]
+	n = len(block[BLOCK_TIME])
+	if n == 0:
+		return None
+	block[BLOCK_TIME] = block[BLOCK_TIME] - starting_time
+	block[LABEL_COLUMN] = label if isinstance(label, numpy.ndarray) else numpy.repeat(numpy.array([label]), n)
+	return block
 
 SCENE_NAMES = (CONNECTING, INTRODUCTION, TRAINING, ENDING) = ('Connecting', 'Introduction', 'Training', 'Ending')
 
@@ -113,7 +136,7 @@ class IntroductionScene(Scene):
 		
 class TrainingScene(Scene):
 	
-	def __init__(self, size, app_font, mind_stream, training_data_output_func, config_obj, num_rounds=NUM_ROUNDS, interval_duration=TRAINING_INTERVAL):
+	def __init__(self, size, app_font, mind_stream, training_data_output_func, config_obj, num_rounds=NUM_ROUNDS, interval_duration=TRAINING_INTERVAL, start_listener=None, running_stats=None, stimulus_listener=None):
 		self.name=TRAINING
 		self.size = size
 		self.font = app_font
@@ -124,16 +147,28 @@ class TrainingScene(Scene):
 		self.training_data = []
 		self.data_output = training_data_output_func
 		self.config = config_obj
+		# called with the start time once training begins
+		self.start_listener = start_listener
+		# per-label feature statistics, updated with every tagged block
+		self.running_stats = running_stats
+		# called with (onset, duration, label) as each color is shown, onset relative to the start time
+		self.stimulus_listener = stimulus_listener
 		
 	def start(self):
 		self.is_started=True
 		self.start_time = time.time()
+		self.current_interval = -1
+		if self.start_listener:
+			self.start_listener(self.start_time)
 		self.round_duration = len(color_set) * self.interval_duration
 		self.pools = ddict(_get_color_pool)
 		def color_builder():
 			(r, i) = calculate_round_interval(self.start_time, self.interval_duration)
 			return self.pools[r].pop()
 		self.colors = ddict(lambda: ddict(color_builder))
+		# when each color actually went up, and its label, for labelling samples by receive time
+		self.shown_times = []
+		self.shown_labels = []
 		# graphics stuff
 		self.prog_bar = utils.ProgressBar(self.size[0], self.size[1] / 10.0, 1.0, bg_color=background_color, border_width=5, border_color=(255,69,0))
 		
@@ -146,14 +181,44 @@ class TrainingScene(Scene):
 		if r >= self.rounds:
 			return QUIT_SCENE_MANAGER_KEYWORD
 		else:
-			train_data = self.mind_stream.getData()
-			tagged_data = tagData(train_data, labels[self._color()], time.time())
+			if steps_done != self.current_interval:
+				self.current_interval = steps_done
+				label = labels[self.colors[r][i]]
+				self.shown_times.append(time.time())
+				self.shown_labels.append(label)
+				if self.stimulus_listener:
+					# on the same clock the samples are labelled by: from when the color
+					# actually went up (late, after a stall) until the next one is due
+					onset = self.shown_times[-1] - self.start_time
+					self.stimulus_listener(onset, (steps_done + 1) * self.interval_duration - onset, label)
+			block = self.mind_stream.drainColumns()
+			if block is None:
+				return
+			# tagging makes the times relative, so hold on to the receive times
+			recv_times = block[BLOCK_TIME]
+			tagged_data = tagData(block, self._labels_at(recv_times), self.start_time)
+			if latency.enabled:
+				latency.observe(latency.TAG, time.time() - recv_times)
 			self.data_output(tagged_data)
+			if latency.enabled:
+				latency.observe(latency.STORE, time.time() - recv_times)
+			if self.running_stats is not None:
+				self.running_stats.update(tagged_data)
 		
 	
 	def _color(self):
 		(r, i) = calculate_round_interval(self.start_time, self.interval_duration)
 		return self.colors[r][i]
+		
+	def _labels_at(self, times):
+		"""
+		Returns the label of the color that was on screen at each of the given
+		times, going by when each color was actually shown. Slots skipped while
+		the main loop was stalled were never on screen, so they never label anything.
+		"""
+		shown = numpy.searchsorted(self.shown_times, times, side='right') - 1
+		# samples from before training started are dropped by tagData, whatever they get here
+		return numpy.array(self.shown_labels)[numpy.maximum(shown, 0)]
 				
 	def render(self):
 		canvas = pygame.Surface(self.size)
@@ -162,13 +227,13 @@ class TrainingScene(Scene):
 		return canvas
 
 #self, size, app_font, mind_stream, training_data_output_func, config_obj, num_rounds=NUM_ROUNDS, interval_duration=TRAINING_INTERVAL
-def generate_scenes(window_size, font, ms, data_agg_func, user_conf):
+def generate_scenes(window_size, font, ms, data_agg_func, user_conf, start_listener=None, running_stats=None, stimulus_listener=None):
 
 	conn = ConnectingScene(window_size, ms, font)
 
 	intro = IntroductionScene(window_size, font)
 
-	train = TrainingScene(window_size, font, ms, data_agg_func, user_conf)
+	train = TrainingScene(window_size, font, ms, data_agg_func, user_conf, start_listener=start_listener, running_stats=running_stats, stimulus_listener=stimulus_listener)
 
 	return (conn, intro, train)
 	
@@ -193,13 +258,16 @@ def configure_trainer():
 		isNewUser=True
 	return (pickle.load(open(CONFIG_OBJECT_FILENAME, 'rb')), isNewUser)
 		
-def runTrainer(screen, manager):
+def runTrainer(screen, manager, session_writer=None, running_stats=None):
 	print 'running training program'
 	while manager.is_running():
 		evts = []
 		for event in pygame.event.get():
 			#Ends program if the 'x' GUI element is clicked
 			if event.type == pygame.QUIT:
+				#Saves whatever was recorded so far
+				if session_writer:
+					session_writer.close(interrupted=True, running_stats=running_stats.to_dict() if running_stats else None)
 				#Ends pygame
 				pygame.quit()
 				#Quits all active threads
@@ -212,35 +280,47 @@ def runTrainer(screen, manager):
 	print 'finished running trainer program'
 
 def main():
+	if MEASURE_LATENCY:
+		latency.enable()
 	# begin connecting asap since it takes a while
-	my_mindstream = MindStream()
+	my_mindstream = MindStream(max_queued=MAX_QUEUED_MESSAGES, overflow=DROP_OLDEST)
 	# get user configuration
 	(user_configuration, isNew) = configure_trainer()
 	user_configuration['id'] += 1
+	# claim the session number now so a crashed session's file is never overwritten
+	pickle.dump(user_configuration, open(CONFIG_OBJECT_FILENAME, 'wb'))
 	# initialize pygame
 	(screen, default_font) = initialize_graphics()
-	# init data collection
-	training_data = []
+	# init data collection; records are streamed to disk as they are tagged, as
+	# plain tuples in Sample.fields order so the analysis code doesn't need eeg.py
+	(username, sid) = (user_configuration['name'], user_configuration['id'])
+	output_filename = os.path.join(os.getcwd(), DATA_OUTPUT_DIRECTORY, '%s_%d%s' % (username, int(sid), STREAM_EXTENSION))
+	session_writer = SessionWriter(output_filename, username, sid, Sample.fields, SESSION_CHUNK_SIZE, SESSION_FSYNC_INTERVAL)
 	def proc_data(data):
-		if not data:
+		if data is None:
 			return
 		elif isinstance(data, collections.Iterable):
-			training_data.extend(data)
+			session_writer.append(data)
 		else:
-			training_data.append(data)
+			session_writer.append([data])
+	# summarized as it is recorded, and saved with the session
+	running_stats = LabelStats(brain_parameters, LABEL_COLUMN)
+	# the colors shown and when, so analysis can cut stimulus-aligned epochs;
+	# written an entry at a time so a crashed session still has it
+	def record_stimulus(onset, duration, label):
+		session_writer.add_metadata_entry('stimulus_schedule', (onset, duration, label))
 	# initialize scenes
-	scenes = generate_scenes(SCREEN_SIZE, default_font, my_mindstream, proc_data, user_configuration)
+	scenes = generate_scenes(SCREEN_SIZE, default_font, my_mindstream, proc_data, user_configuration, session_writer.set_start_time, running_stats, record_stimulus)
 	manager = SceneManager(scenes)
 	# run the program
-	runTrainer(screen, manager)
+	runTrainer(screen, manager, session_writer, running_stats)
 	# clean up
-	train_start_time = manager.scenes[2].start_time
-	(username, sid) = (user_configuration['name'], user_configuration['id'])
-	pdump = {'start_time':train_start_time, 'data':training_data, 'user':user_configuration['name'], 'session_number':user_configuration['id']}
-	output_filename = os.path.join(os.getcwd(), DATA_OUTPUT_DIRECTORY, '%s_%d.p' % (username, int(sid)))
-	pickle.dump(pdump, open(output_filename, 'wb'))
-	pickle.dump(user_configuration, open(CONFIG_OBJECT_FILENAME, 'wb'))
-	print 'training data dumped to file, exiting program'
+	session_writer.close(interrupted=False, running_stats=running_stats.to_dict())
+	print 'training data written to %s (%d records), exiting program' % (output_filename, session_writer.record_count)
+	print running_stats.format_report()
+	print 'headset queue stats: %s' % my_mindstream.getQueueStats()
+	if latency.enabled:
+		print latency.registry.format_report()
 	
 if __name__ == '__main__':
 	main()
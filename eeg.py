@@ -9,9 +9,15 @@ Copyright (c) 2012 Michael Sobczak. All rights reserved.
 
 from socket import *
 import json
-from threading import Thread, Event
+import re
+from threading import Thread, Event, Lock, Condition
+from select import select
+from collections import deque
 import Queue
 import time
+import numpy
+
+import latency
 from sys import stderr
 
 HOST = '127.0.0.1'
@@ -20,6 +26,13 @@ ADDR = (HOST, PORT)
 headset_conf_dict = {'enableRawOutput':False, 'format':'Json'}
 HEADSET_JSON_SEPARATOR = '\r'
 NULL_DATA = {'poorSignalLevel':200}
+RECV_BUFFER_SIZE = 8192
+ASYNC_MAX_BUFFERED = 4096 # messages kept per headset before the oldest are dropped
+ASYNC_POLL_INTERVAL = 0.25 # seconds
+RAW_SAMPLE_RATE = 512 # samples per second
+RAW_BUFFER_SECONDS = 60 # how much raw signal the ring buffer holds
+# what a bounded MindStream queue does with a new message once it is full
+OVERFLOW_POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST, COALESCE) = ('block', 'drop-oldest', 'drop-newest', 'coalesce')
 
 # this is the data that the ThinkGearConnector sends out
 brain_parameters = (
@@ -33,6 +46,87 @@ brain_parameters = (
 # these are the two general categories of brainwave data
 parameter_categories = (eSense, eegPower) = ('eSense', 'eegPower')	
 
+# name of the receive timestamp column in blocks returned by MindStream.drainColumns
+BLOCK_TIME = 'time'
+
+# in raw mode the connector also sends one of these per sample
+rawEeg = 'rawEeg'
+
+
+class Sample(object):
+	"""
+	A single eSense+eegPower reading from the headset.
+	
+	Values are stored in slots in brain_parameters order, followed by the time the 
+	sample was received (later rewritten by the trainer as time into the session) 
+	and the label it was tagged with. Supports read-only dictionary-style access 
+	so code written against the old message dictionaries keeps working.
+	"""
+	
+	fields = brain_parameters + ('time', 'label')
+	__slots__ = fields
+	
+	def __init__(self, values, time=None, label=None):
+		(self.lowAlpha, self.highAlpha, self.lowBeta, self.highBeta,
+		self.lowGamma, self.highGamma, self.delta, self.theta,
+		self.poorSignalLevel, self.meditation, self.attention) = values
+		self.time = time
+		self.label = label
+		
+	def brain_values(self):
+		"""Returns the brain parameter values in brain_parameters order."""
+		return (self.lowAlpha, self.highAlpha, self.lowBeta, self.highBeta,
+			self.lowGamma, self.highGamma, self.delta, self.theta,
+			self.poorSignalLevel, self.meditation, self.attention)
+			
+	def as_tuple(self):
+		"""Returns every field, in Sample.fields order."""
+		return self.brain_values() + (self.time, self.label)
+		
+	def as_dict(self):
+		return dict(zip(Sample.fields, self.as_tuple()))
+		
+	def keys(self):
+		return list(Sample.fields)
+		
+	def values(self):
+		return list(self.as_tuple())
+		
+	def items(self):
+		return zip(Sample.fields, self.as_tuple())
+		
+	def get(self, key, default=None):
+		return getattr(self, key) if key in Sample.fields else default
+		
+	def __getitem__(self, key):
+		if key not in Sample.fields:
+			raise KeyError(key)
+		return getattr(self, key)
+		
+	def __contains__(self, key):
+		return key in Sample.fields
+		
+	def __iter__(self):
+		return iter(Sample.fields)
+		
+	def __len__(self):
+		return len(Sample.fields)
+		
+	def __getstate__(self):
+		return self.as_tuple()
+		
+	def __setstate__(self, state):
+		self.__init__(state[:-2], state[-2], state[-1])
+		
+	def __eq__(self, other):
+		return isinstance(other, Sample) and self.as_tuple() == other.as_tuple()
+		
+	def __ne__(self, other):
+		return not self == other
+		
+	def __repr__(self):
+		return 'Sample(%r)' % (self.as_dict(),)
+
 
 def _extract_tuple(data_dict):
 	"""Returns a tuple of the values extracted from a message dictionary."""
@@ -50,39 +144,142 @@ def _extract_tuple(data_dict):
 		data_dict[eSense][attention])
 
 
-def _create_and_connect_socket(host, port):
+def _create_and_connect_socket(host, port, raw=False):
 	cs = socket(AF_INET, SOCK_STREAM)
 	cs.connect((host, port))
-	cs.send(json.dumps(headset_conf_dict))
+	conf = dict(headset_conf_dict)
+	conf['enableRawOutput'] = raw
+	cs.send(json.dumps(conf))
 	return cs
 
 
-def _event_stream(shutdown_func, host, port):
-	soc = _create_and_connect_socket(host,port)
+def _frame_stream(soc, shutdown_func, buffer_size=RECV_BUFFER_SIZE):
+	"""
+	Yields (read_time, frame) for the separator-delimited frames read off of the socket.
 	
+	Reads are done in large chunks into a single reusable buffer, and any partial 
+	frame left at the end of a chunk is carried over into the next read. The read 
+	time is when the chunk completing the frame came off the socket.
+	"""
+	buf = bytearray(buffer_size)
+	view = memoryview(buf)
+	partial = ''
 	while not shutdown_func():
-		temp_json = ''
-		cur_char = soc.recv(1)
-		while cur_char != HEADSET_JSON_SEPARATOR:
-			temp_json += cur_char
-			cur_char = soc.recv(1)
-		data = None
-		try:
-			data = json.loads(temp_json)
-		except ValueError:
-			pass#stderr.write('Error while decoding JSON object, discarding data')
-		if data:
-			if eSense in data and eegPower in data:
-				yield dict(zip(brain_parameters, _extract_tuple(data)))
-			else:
-				yield data
-	cs.close()
+		n = soc.recv_into(buf)
+		read_time = time.time()
+		if n == 0:
+			# connector closed the connection
+			break
+		frames = (partial + view[:n].tobytes()).split(HEADSET_JSON_SEPARATOR)
+		partial = frames.pop()
+		for frame in frames:
+			if frame:
+				yield (read_time, frame)
+
+
+# frames are matched to a known shape by their skeleton, i.e. the frame with its numbers removed
+_NUMBER_CHARS = '0123456789-'
+# translation table that blanks out everything but the numbers, which is much quicker than a regex
+_NUMBERS_ONLY = ''.join(c if c in _NUMBER_CHARS else ' ' for c in map(chr, range(256)))
+_INT_FIELD = re.compile(r'"(\w+)"\s*:\s*(-?\d+)')
+# skeleton -> how to decode it: (SAMPLE_SHAPE, positions of brain_parameters among the 
+# frame's numbers, count of numbers), (SINGLE_SHAPE, key, 1), or None for frames only 
+# json can handle
+_frame_shapes = {}
+(SAMPLE_SHAPE, SINGLE_SHAPE) = ('sample', 'single')
+MAX_FRAME_SHAPES = 64
+
+
+def _learn_frame_shape(frame, data):
+	"""Works out how to decode frames shaped like this one, given its json decoding."""
+	if '.' in frame:
+		return None
+	names = [name for (name, value) in _INT_FIELD.findall(frame)]
+	if len(names) != len(frame.translate(_NUMBERS_ONLY).split()):
+		# numbers that aren't simple "name": value pairs
+		return None
+	if isinstance(data, Sample) and sorted(names) == sorted(brain_parameters):
+		return (SAMPLE_SHAPE, [names.index(p) for p in brain_parameters], len(names))
+	if isinstance(data, dict) and len(data) == 1 and names == data.keys() and isinstance(data.values()[0], int):
+		return (SINGLE_SHAPE, names[0], 1)
+	return None
+
+
+def _decode_known_frame(frame):
+	"""
+	Decodes frames whose shape has been seen before without going through json: 
+	eSense+eegPower samples go straight into a Sample, and single-value frames 
+	(rawEeg, poorSignalLevel, blinkStrength) become a one-key dictionary. Returns 
+	None for unknown shapes so the caller can fall back to json.
+	"""
+	shape = _frame_shapes.get(frame.translate(None, _NUMBER_CHARS))
+	if shape is None:
+		return None
+	numbers = frame.translate(_NUMBERS_ONLY).split()
+	if len(numbers) != shape[2]:
+		# the skeleton also drops digits from key names, so e.g. {"k1":5} looks like a
+		# learned {"k":15}; learned shapes only have digits in their values, so any 
+		# extra run of digits means a different frame
+		return None
+	if shape[0] == SAMPLE_SHAPE:
+		return Sample(tuple([int(numbers[i]) for i in shape[1]]))
+	return {shape[1]:int(numbers[0])}
+
+
+def _decode_json_frame(frame):
+	"""Decodes any frame with the json module, or returns None if it isn't valid."""
+	data = None
+	try:
+		data = json.loads(frame)
+	except ValueError:
+		pass#stderr.write('Error while decoding JSON object, discarding data')
+	if not data:
+		return None
+	if eSense in data and eegPower in data:
+		return Sample(_extract_tuple(data))
+	return data
+
+
+def _decode_frame(frame):
+	"""Turns a single frame into a message, or None if the frame can't be decoded."""
+	data = _decode_known_frame(frame)
+	if data is None:
+		data = _decode_json_frame(frame)
+		skeleton = frame.translate(None, _NUMBER_CHARS)
+		if data is not None and skeleton not in _frame_shapes and len(_frame_shapes) < MAX_FRAME_SHAPES:
+			_frame_shapes[skeleton] = _learn_frame_shape(frame, data)
+	return data
+
+
+def _event_stream(shutdown_func, host, port, raw=False):
+	"""
+	Yields (read_time, message) for every message decoded off of the connector. 
+	Samples are also stamped with their read time; raw values are single-key 
+	dictionaries, so they only get it alongside.
+	"""
+	soc = _create_and_connect_socket(host, port, raw)
+	
+	try:
+		for (read_time, frame) in _frame_stream(soc, shutdown_func):
+			data = _decode_frame(frame)
+			if data:
+				if isinstance(data, Sample):
+					data.time = read_time
+					if latency.enabled:
+						latency.observe(latency.DECODE, time.time() - read_time)
+				yield (read_time, data)
+			elif latency.enabled:
+				latency.count('undecodable')
+			if shutdown_func():
+				break
+	finally:
+		soc.close()
 	
 	
-def _processEEGStream(queue, shutdown_flag, connected_flag, host, port):
-	eegGen = _event_stream(lambda: shutdown_flag.isSet(), host, port)
+def _processEEGStream(queue, shutdown_flag, connected_flag, host, port, raw_buffer=None):
+	eegGen = _event_stream(lambda: shutdown_flag.isSet(), host, port, raw_buffer is not None)
 	
-	next_msg = lambda: eegGen.next()
+	next_msg = lambda: eegGen.next()[1]
 	
 	# loop and discard data until connection is made
 	while not connected_flag.isSet():
@@ -91,23 +288,178 @@ def _processEEGStream(queue, shutdown_flag, connected_flag, host, port):
 			connected_flag.set()
 			
 	# now getting real data
-	for data in eegGen:
+	for (read_time, data) in eegGen:
 		#print 'putting %s in queue' % str(data)
-		queue.put(data)
+		if raw_buffer is not None and rawEeg in data:
+			# stamped with the socket read time, like the samples, so the two line up
+			raw_buffer.append(data[rawEeg], read_time)
+		else:
+			queue.put(data)
+			if latency.enabled and isinstance(data, Sample):
+				latency.observe(latency.ENQUEUE, time.time() - data.time)
 		
 	connected_flag.clear()
 
 
+def _build_block(items):
+	"""Turns drained messages into a columnar block of the Samples among them."""
+	samples = [s for s in items if isinstance(s, Sample)]
+	if not samples:
+		return None
+	block = {BLOCK_TIME: numpy.fromiter((s.time for s in samples), numpy.float64, len(samples))}
+	values = numpy.array([s.brain_values() for s in samples], dtype=numpy.int64)
+	# transpose into one contiguous array per parameter
+	for (p, column) in zip(brain_parameters, values.T.copy()):
+		block[p] = column
+	return block
+
+
+class RawBuffer(object):
+	"""
+	Preallocated ring buffer of raw EEG samples and their receive timestamps.
+	
+	Every sample is written twice, capacity slots apart, so the most recent n 
+	samples are always contiguous in memory and read_window can hand out a view 
+	instead of a copy. A view stays valid until capacity - n further samples 
+	have been appended; copy it if it needs to live longer than that.
+	"""
+	
+	def __init__(self, capacity=RAW_SAMPLE_RATE * RAW_BUFFER_SECONDS):
+		self.capacity = capacity
+		self.values = numpy.zeros(2 * capacity, dtype=numpy.int16)
+		self.times = numpy.zeros(2 * capacity, dtype=numpy.float64)
+		self.pos = 0
+		self.count = 0
+		
+	def append(self, value, timestamp):
+		(pos, cap) = (self.pos, self.capacity)
+		self.values[pos] = self.values[pos + cap] = value
+		self.times[pos] = self.times[pos + cap] = timestamp
+		self.pos = (pos + 1) % cap
+		self.count += 1
+		
+	def __len__(self):
+		return min(self.count, self.capacity)
+		
+	def read_window(self, n=None):
+		"""Returns (values, timestamps) views of the last n samples, oldest first."""
+		available = len(self)
+		n = available if n is None else min(n, available)
+		end = self.pos + self.capacity
+		return (self.values[end - n:end], self.times[end - n:end])
+
+
+class IngestQueue(Queue.Queue):
+	"""
+	Queue between the ingest thread and the consumer, optionally bounded.
+	
+	With a maxsize of 0 the queue is unbounded. Otherwise a put on a full queue 
+	follows the overflow policy:
+		BLOCK       - wait for the consumer to make room, raising Queue.Full as 
+		              Queue.Queue does if block is false or the timeout runs out
+		DROP_OLDEST - discard the oldest queued message
+		DROP_NEWEST - discard the incoming message
+		COALESCE    - discard the whole backlog and keep only the incoming message
+	Counts of enqueued and dropped messages and the high-water mark are kept, and 
+	while latency instrumentation is enabled so are the times messages were put, 
+	so drain() can report how long they sat in the queue.
+	"""
+	
+	def __init__(self, maxsize=0, policy=BLOCK):
+		if policy not in OVERFLOW_POLICIES:
+			raise ValueError('unknown overflow policy %r' % (policy,))
+		Queue.Queue.__init__(self, maxsize)
+		self.policy = policy
+		self.enqueued = 0
+		self.dropped = 0
+		self.high_water = 0
+		self.closed = False
+		# put times, parallel to self.queue (None while instrumentation is off)
+		self.put_times = deque()
+		
+	def put(self, item, block=True, timeout=None):
+		with self.not_full:
+			if self.maxsize > 0 and self._qsize() >= self.maxsize:
+				if self.policy == BLOCK:
+					if not block:
+						raise Queue.Full
+					if timeout is not None and timeout < 0:
+						raise ValueError("'timeout' must be a non-negative number")
+					deadline = None if timeout is None else time.time() + timeout
+					while self._qsize() >= self.maxsize and not self.closed:
+						# wake up periodically so close() can release a stalled producer
+						wait = ASYNC_POLL_INTERVAL
+						if deadline is not None:
+							remaining = deadline - time.time()
+							if remaining <= 0:
+								raise Queue.Full
+							wait = min(wait, remaining)
+						self.not_full.wait(wait)
+					if self.closed:
+						self.dropped += 1
+						return
+				elif self.policy == DROP_OLDEST:
+					self._get()
+					self.dropped += 1
+				elif self.policy == DROP_NEWEST:
+					self.dropped += 1
+					return
+				elif self.policy == COALESCE:
+					self.dropped += self._qsize()
+					self.queue.clear()
+					self.put_times.clear()
+			self._put(item)
+			self.unfinished_tasks += 1
+			self.not_empty.notify()
+			
+	def _put(self, item):
+		self.queue.append(item)
+		self.put_times.append(time.time() if latency.enabled else None)
+		self.enqueued += 1
+		if len(self.queue) > self.high_water:
+			self.high_water = len(self.queue)
+			
+	def _get(self):
+		self.put_times.popleft()
+		return self.queue.popleft()
+		
+	def drain(self):
+		"""Takes everything currently in the queue in one locked operation."""
+		with self.mutex:
+			items = list(self.queue)
+			put_times = self.put_times
+			self.queue.clear()
+			self.put_times = deque()
+			self.not_full.notifyAll()
+		if latency.enabled and items:
+			now = time.time()
+			latency.observe(latency.RESIDENCE, [now - t for t in put_times if t is not None])
+			latency.observe(latency.DRAIN, [now - s.time for s in items if isinstance(s, Sample)])
+		return items
+		
+	def close(self):
+		"""Stops blocking producers; anything they were trying to put is counted as dropped."""
+		with self.not_full:
+			self.closed = True
+			self.not_full.notifyAll()
+			
+	def stats(self):
+		with self.mutex:
+			return {'enqueued':self.enqueued, 'dropped':self.dropped, 'high_water':self.high_water, 'size':self._qsize(), 'maxsize':self.maxsize, 'policy':self.policy}
+
+
 class MindStream(object):
 	
-	def __init__(self, host=HOST, port=PORT):
+	def __init__(self, host=HOST, port=PORT, raw=False, raw_capacity=RAW_SAMPLE_RATE * RAW_BUFFER_SECONDS, max_queued=0, overflow=BLOCK):
 		self.host = host
 		self.port = port
+		# raw samples bypass the queue and go straight into the ring buffer
+		self.raw_buffer = RawBuffer(raw_capacity) if raw else None
 		# thread communication stuff
 		self.shutdown_flag = Event()
 		self.is_connected_flag = Event()
-		self.queue = Queue.Queue()
-		self.stream_thread = Thread(target=_processEEGStream, args=(self.queue, self.shutdown_flag, self.is_connected_flag, self.host, self.port))
+		self.queue = IngestQueue(max_queued, overflow)
+		self.stream_thread = Thread(target=_processEEGStream, args=(self.queue, self.shutdown_flag, self.is_connected_flag, self.host, self.port, self.raw_buffer))
 		self.stream_thread.start()
 		
 	def isConnected(self):
@@ -115,13 +467,32 @@ class MindStream(object):
 		
 	def shutdown(self):
 		self.shutdown_flag.set()
+		self.queue.close()
+		
+	def getQueueStats(self):
+		"""Returns the ingest queue's enqueued/dropped counts, high-water mark, current size and policy."""
+		return self.queue.stats()
+		
+	def read_window(self, n=None):
+		"""Returns views of the last n raw samples and their receive times (raw mode only)."""
+		if self.raw_buffer is None:
+			raise ValueError('MindStream was not started in raw mode')
+		return self.raw_buffer.read_window(n)
+		
+	def _drain(self):
+		return self.queue.drain()
+		
+	def drainColumns(self):
+		"""
+		Drains the queue and returns the complete samples in it as a columnar block: 
+		a dictionary with one numpy array per name in brain_parameters plus a 
+		BLOCK_TIME array of receive timestamps. Messages that aren't full samples 
+		(blinks, signal-only updates) are discarded. Returns None if there is no data.
+		"""
+		return _build_block(self._drain())
 		
 	def getData(self):
-		stuff = []
-		while not self.queue.empty():
-			item = self.queue.get()
-			if item:
-				stuff.append(item)
+		stuff = [data for data in self._drain() if data]
 		return stuff if len(stuff) > 0 else None
 		
 	def __del__(self):
@@ -129,6 +500,179 @@ class MindStream(object):
 		self.stream_thread.join()
 		
 
+class AsyncMindStream(object):
+	"""
+	A non-blocking connection to one ThinkGear connector.
+	
+	Has the same isConnected/getData/shutdown surface as MindStream, but owns no 
+	thread of its own: a MindStreamHub drives the socket from its select loop, 
+	and received messages are kept in a bounded buffer that drops the oldest 
+	messages once it is full. Iterating over the stream yields messages as they 
+	arrive until the stream is shut down.
+	"""
+	
+	(CONNECTING, WAITING, STREAMING, CLOSED) = ('connecting', 'waiting', 'streaming', 'closed')
+	
+	def __init__(self, hub, host=HOST, port=PORT, max_buffered=ASYNC_MAX_BUFFERED):
+		self.hub = hub
+		self.host = host
+		self.port = port
+		self.buffer = deque(maxlen=max_buffered)
+		self.dropped = 0
+		self.state = AsyncMindStream.CONNECTING
+		self.partial = ''
+		self.data_ready = Condition()
+		self.soc = socket(AF_INET, SOCK_STREAM)
+		self.soc.setblocking(0)
+		self.soc.connect_ex((host, port))
+		
+	def fileno(self):
+		return self.soc.fileno()
+		
+	def wantsWrite(self):
+		return self.state == AsyncMindStream.CONNECTING
+		
+	def isConnected(self):
+		return self.state == AsyncMindStream.STREAMING
+		
+	def isClosed(self):
+		return self.state == AsyncMindStream.CLOSED
+		
+	def shutdown(self):
+		if self.state != AsyncMindStream.CLOSED:
+			self.state = AsyncMindStream.CLOSED
+			self.soc.close()
+		with self.data_ready:
+			self.data_ready.notifyAll()
+		
+	def getData(self):
+		with self.data_ready:
+			stuff = list(self.buffer)
+			self.buffer.clear()
+		return stuff if len(stuff) > 0 else None
+		
+	def __iter__(self):
+		while True:
+			with self.data_ready:
+				while not self.buffer and not self.isClosed():
+					self.data_ready.wait(ASYNC_POLL_INTERVAL)
+				if not self.buffer:
+					return
+				stuff = list(self.buffer)
+				self.buffer.clear()
+			for item in stuff:
+				yield item
+				
+	def handleWrite(self):
+		"""Called by the hub once the non-blocking connect has finished."""
+		if self.soc.getsockopt(SOL_SOCKET, SO_ERROR) != 0:
+			self.shutdown()
+			return
+		self.soc.setblocking(1)
+		self.soc.sendall(json.dumps(headset_conf_dict))
+		self.soc.setblocking(0)
+		self.state = AsyncMindStream.WAITING
+		
+	def handleRead(self, buf, view):
+		"""Called by the hub when the socket is readable; buf is the hub's shared read buffer."""
+		try:
+			n = self.soc.recv_into(buf)
+		except error:
+			n = 0
+		if n == 0:
+			self.shutdown()
+			return
+		frames = (self.partial + view[:n].tobytes()).split(HEADSET_JSON_SEPARATOR)
+		self.partial = frames.pop()
+		now = time.time()
+		messages = []
+		for frame in frames:
+			msg = _decode_frame(frame) if frame else None
+			if not msg:
+				continue
+			if isinstance(msg, Sample):
+				msg.time = now
+			if self.state == AsyncMindStream.WAITING:
+				# discard data until the headset is actually sending something
+				if not msg == NULL_DATA:
+					self.state = AsyncMindStream.STREAMING
+				continue
+			messages.append(msg)
+		if messages:
+			with self.data_ready:
+				overflow = len(self.buffer) + len(messages) - self.buffer.maxlen
+				if overflow > 0:
+					self.dropped += overflow
+				self.buffer.extend(messages)
+				self.data_ready.notifyAll()
+
+
+class MindStreamHub(object):
+	"""
+	Serves any number of AsyncMindStreams from a single thread using select.
+	
+	usage:
+		hub = MindStreamHub()
+		streams = [hub.connect(HOST, port) for port in ports]
+		...
+		hub.shutdown()
+	"""
+	
+	def __init__(self, buffer_size=RECV_BUFFER_SIZE):
+		self.streams = []
+		self.streams_lock = Lock()
+		self.buf = bytearray(buffer_size)
+		self.view = memoryview(self.buf)
+		self.shutdown_flag = Event()
+		self.hub_thread = Thread(target=self._run)
+		self.hub_thread.daemon = True
+		self.hub_thread.start()
+		
+	def connect(self, host=HOST, port=PORT, max_buffered=ASYNC_MAX_BUFFERED):
+		stream = AsyncMindStream(self, host, port, max_buffered)
+		with self.streams_lock:
+			self.streams.append(stream)
+		return stream
+		
+	def isConnected(self):
+		with self.streams_lock:
+			return len(self.streams) > 0 and all(s.isConnected() for s in self.streams)
+		
+	def getData(self):
+		"""Returns a dictionary of (host, port) to the data drained from each stream."""
+		with self.streams_lock:
+			streams = list(self.streams)
+		return dict(((s.host, s.port), s.getData()) for s in streams)
+		
+	def shutdown(self):
+		self.shutdown_flag.set()
+		with self.streams_lock:
+			for s in self.streams:
+				s.shutdown()
+		self.hub_thread.join()
+		
+	def _run(self):
+		while not self.shutdown_flag.isSet():
+			with self.streams_lock:
+				# closed streams stay registered so their buffered data can still be drained
+				live = [s for s in self.streams if not s.isClosed()]
+			readers = [s for s in live if not s.wantsWrite()]
+			writers = [s for s in live if s.wantsWrite()]
+			if not readers and not writers:
+				self.shutdown_flag.wait(ASYNC_POLL_INTERVAL)
+				continue
+			try:
+				(readable, writable, _) = select(readers, writers, [], ASYNC_POLL_INTERVAL)
+			except (error, ValueError):
+				# a stream was shut down from another thread mid-select
+				continue
+			for s in writable:
+				s.handleWrite()
+			for s in readable:
+				if not s.isClosed():
+					s.handleRead(self.buf, self.view)
+		
+
 def runTest():
 	ms = MindStream()
 	print 'attempting to connect to headset'
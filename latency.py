@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+latency.py
+
+Optional per-stage latency instrumentation for the path a headset sample takes
+from the socket to the stored training record:
+
+	decode   - socket read until the frame is decoded
+	enqueue  - socket read until the sample is in the MindStream queue
+	residence - time spent waiting in the queue
+	drain    - socket read until the consumer drained it
+	tag      - socket read until tagData labelled it
+	store    - socket read until the record was handed to the session output
+
+Everything is off by default, and callers guard their timing code with
+`if latency.enabled:` so a disabled registry costs one attribute lookup.
+"""
+
+import math
+import time
+import threading
+import numpy
+
+STAGES = (DECODE, ENQUEUE, RESIDENCE, DRAIN, TAG, STORE) = ('decode', 'enqueue', 'residence', 'drain', 'tag', 'store')
+
+# histogram buckets are spaced 4 per power of two, starting at 1 microsecond
+BUCKETS_PER_OCTAVE = 4
+MIN_LATENCY = 1e-6
+NUM_BUCKETS = 30 * BUCKETS_PER_OCTAVE # up to ~1000 seconds
+
+enabled = False
+
+
+class Histogram(object):
+	"""Log-bucketed latency histogram that can answer approximate percentiles."""
+
+	def __init__(self):
+		self.counts = numpy.zeros(NUM_BUCKETS, dtype=numpy.int64)
+		self.total = 0.0
+		self.max = 0.0
+		self.first = None
+		self.last = None
+
+	@staticmethod
+	def _bucket_of(seconds):
+		b = numpy.floor(numpy.log2(numpy.maximum(seconds, MIN_LATENCY) / MIN_LATENCY) * BUCKETS_PER_OCTAVE)
+		return numpy.clip(b.astype(numpy.int64), 0, NUM_BUCKETS - 1)
+
+	def observe(self, latencies, now):
+		latencies = numpy.atleast_1d(numpy.asarray(latencies, dtype=numpy.float64))
+		if len(latencies) == 0:
+			return
+		self.counts += numpy.bincount(Histogram._bucket_of(latencies), minlength=NUM_BUCKETS)
+		self.total += latencies.sum()
+		self.max = max(self.max, latencies.max())
+		if self.first is None:
+			self.first = now
+		self.last = now
+
+	def count(self):
+		return int(self.counts.sum())
+
+	def percentile(self, p):
+		"""Returns the upper bound of the bucket holding the p-th percentile, in seconds."""
+		n = self.count()
+		if n == 0:
+			return None
+		rank = int(math.ceil(p / 100.0 * n))
+		bucket = int(numpy.searchsorted(numpy.cumsum(self.counts), max(rank, 1)))
+		return min(MIN_LATENCY * 2 ** ((bucket + 1) / float(BUCKETS_PER_OCTAVE)), self.max)
+
+	def summary(self):
+		n = self.count()
+		span = (self.last - self.first) if n > 1 else 0.0
+		return {
+			'count':n,
+			'mean':self.total / n if n else None,
+			'p50':self.percentile(50),
+			'p99':self.percentile(99),
+			'max':self.max if n else None,
+			'per_second':n / span if span > 0 else None}
+
+
+class Registry(object):
+	"""Named latency histograms and counters, shared by every thread in the process."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.histograms = {}
+		self.counters = {}
+
+	def observe(self, stage, latencies):
+		now = time.time()
+		with self.lock:
+			if stage not in self.histograms:
+				self.histograms[stage] = Histogram()
+			self.histograms[stage].observe(latencies, now)
+
+	def count(self, name, n=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	def reset(self):
+		with self.lock:
+			self.histograms = {}
+			self.counters = {}
+
+	def report(self):
+		"""Returns a dictionary of stage name to its latency summary, plus the counters."""
+		with self.lock:
+			stages = dict((name, h.summary()) for (name, h) in self.histograms.items())
+			return {'stages':stages, 'counters':dict(self.counters)}
+
+	def format_report(self):
+		rep = self.report()
+		ms = lambda s: '%9.3f' % (s * 1000.0) if s is not None else '        -'
+		lines = ['%-10s %8s %9s %9s %9s %9s %10s' % ('stage', 'count', 'mean ms', 'p50 ms', 'p99 ms', 'max ms', 'per sec')]
+		ordered = [s for s in STAGES if s in rep['stages']] + sorted(s for s in rep['stages'] if s not in STAGES)
+		for name in ordered:
+			s = rep['stages'][name]
+			rate = '%10.1f' % s['per_second'] if s['per_second'] is not None else '         -'
+			lines.append('%-10s %8d %s %s %s %s %s' % (name, s['count'], ms(s['mean']), ms(s['p50']), ms(s['p99']), ms(s['max']), rate))
+		for (name, value) in sorted(rep['counters'].items()):
+			lines.append('%-10s %8d' % (name, value))
+		return '\n'.join(lines)
+
+	def dump(self, filename):
+		with open(filename, 'w') as f:
+			f.write(self.format_report() + '\n')
+
+
+registry = Registry()
+
+
+def enable():
+	global enabled
+	enabled = True
+
+
+def disable():
+	global enabled
+	enabled = False
+
+
+def observe(stage, latencies):
+	registry.observe(stage, latencies)
+
+
+def count(name, n=1):
+	registry.count(name, n)
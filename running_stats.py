@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+running_stats.py
+
+Incremental per-label feature statistics, cheap enough to keep up to date while
+the trainer is recording.
+
+RunningStats keeps a count, mean and sum of squared deviations (Welford's
+method, updated a batch at a time with Chan's combination formula), the
+minimum and maximum, and a log-bucketed histogram for estimating quantiles.
+Every part of it can be merged with another RunningStats, so summaries of
+separate sessions, or separate users, combine into exactly the summary of the
+pooled data (the quantiles to within a bucket, about 4.5%).
+
+RunningCovariance does the same for the mean vector and co-moment matrix of
+several features at once, giving mergeable covariance matrices.
+
+LabelStats holds one RunningStats per (label, feature). The trainer feeds it
+each tagged block and stores to_dict() in the session footer, where the
+analysis code can pick it up and combine() it with other sessions' without
+reading their records.
+"""
+
+import math
+import numpy
+
+BUCKETS_PER_OCTAVE = 8
+QUANTILES = (0.25, 0.5, 0.75)
+
+
+def _buckets(values):
+	"""Returns the histogram bucket of each value: sign(v) * floor(log2(1 + |v|) * BUCKETS_PER_OCTAVE)."""
+	values = numpy.asarray(values, dtype=numpy.float64)
+	return (numpy.sign(values) * numpy.floor(numpy.log2(1 + numpy.abs(values)) * BUCKETS_PER_OCTAVE)).astype(numpy.int64)
+
+
+def _bucket_value(bucket):
+	"""Returns the value in the middle of a bucket, on the log scale."""
+	if bucket == 0:
+		return 0.0
+	return math.copysign(2 ** ((abs(bucket) + 0.5) / BUCKETS_PER_OCTAVE) - 1, bucket)
+
+
+class RunningStats(object):
+	"""Mergeable running count, mean, variance, min, max and quantile estimates of one feature."""
+
+	def __init__(self):
+		self.count = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.min = None
+		self.max = None
+		self.histogram = {}
+
+	def _combine(self, count, mean, m2, lo, hi):
+		total = self.count + count
+		delta = mean - self.mean
+		self.mean += delta * count / total
+		self.m2 += m2 + delta * delta * self.count * count / total
+		self.count = total
+		self.min = lo if self.min is None else min(self.min, lo)
+		self.max = hi if self.max is None else max(self.max, hi)
+
+	def add(self, values):
+		"""Adds a value or an array of values."""
+		values = numpy.atleast_1d(numpy.asarray(values, dtype=numpy.float64))
+		if len(values) == 0:
+			return
+		mean = values.mean()
+		deviation = values - mean
+		self._combine(len(values), mean, float(numpy.dot(deviation, deviation)), values.min(), values.max())
+		(buckets, counts) = numpy.unique(_buckets(values), return_counts=True)
+		for (b, n) in zip(buckets.tolist(), counts.tolist()):
+			self.histogram[b] = self.histogram.get(b, 0) + n
+
+	def merge(self, other):
+		"""Folds another RunningStats into this one."""
+		if other.count == 0:
+			return self
+		self._combine(other.count, other.mean, other.m2, other.min, other.max)
+		for (b, n) in other.histogram.items():
+			self.histogram[b] = self.histogram.get(b, 0) + n
+		return self
+
+	def variance(self):
+		"""Population variance, as numpy.var computes it."""
+		return self.m2 / self.count if self.count else None
+
+	def std(self):
+		return math.sqrt(self.variance()) if self.count else None
+
+	def quantile(self, q):
+		"""Estimates the q-th quantile (0 <= q <= 1) from the histogram."""
+		if not self.count:
+			return None
+		rank = max(int(math.ceil(q * self.count)), 1)
+		seen = 0
+		for b in sorted(self.histogram):
+			seen += self.histogram[b]
+			if seen >= rank:
+				return min(max(_bucket_value(b), self.min), self.max)
+		return self.max
+
+	def summary(self, quantiles=QUANTILES):
+		s = {'count':self.count, 'mean':self.mean if self.count else None, 'var':self.variance(),
+			'std':self.std(), 'min':self.min, 'max':self.max}
+		for q in quantiles:
+			s['q%g' % (q * 100)] = self.quantile(q)
+		return s
+
+	def to_dict(self):
+		"""Returns the state as plain, JSON-safe values."""
+		return {'count':self.count, 'mean':float(self.mean), 'm2':float(self.m2),
+			'min':None if self.min is None else float(self.min),
+			'max':None if self.max is None else float(self.max),
+			'histogram':sorted([b, n] for (b, n) in self.histogram.items())}
+
+	@classmethod
+	def from_dict(cls, d):
+		stats = cls()
+		(stats.count, stats.mean, stats.m2, stats.min, stats.max) = (d['count'], d['mean'], d['m2'], d['min'], d['max'])
+		stats.histogram = dict((int(b), n) for (b, n) in d['histogram'])
+		return stats
+
+
+class RunningCovariance(object):
+	"""Mergeable running count, mean vector and co-moment matrix of a fixed list of features."""
+
+	def __init__(self, num_features):
+		self.count = 0
+		self.mean = numpy.zeros(num_features)
+		self.comoment = numpy.zeros((num_features, num_features))
+
+	def _combine(self, count, mean, comoment):
+		total = self.count + count
+		delta = mean - self.mean
+		self.comoment += comoment + numpy.outer(delta, delta) * (self.count * count / float(total))
+		self.mean += delta * (count / float(total))
+		self.count = total
+
+	def add(self, points):
+		"""Adds an array with one row per point and one column per feature."""
+		points = numpy.asarray(points, dtype=numpy.float64)
+		if len(points) == 0:
+			return
+		mean = points.mean(axis=0)
+		centred = points - mean
+		self._combine(len(points), mean, centred.T.dot(centred))
+
+	def merge(self, other):
+		"""Folds another RunningCovariance over the same features into this one."""
+		if other.count:
+			self._combine(other.count, other.mean, other.comoment)
+		return self
+
+	def covariance(self):
+		"""Covariance matrix normalized by the count, as numpy.cov(bias=True) computes it."""
+		return self.comoment / self.count
+
+
+class LabelStats(object):
+	"""
+	RunningStats for every feature under every label.
+
+	:features lists the columns to track; by default every numeric column of
+	the first block except the label is tracked.
+	"""
+
+	def __init__(self, features=None, label_key='label'):
+		self.features = list(features) if features is not None else None
+		self.label_key = label_key
+		self.stats = {}
+
+	def get(self, label, feature):
+		if (label, feature) not in self.stats:
+			self.stats[(label, feature)] = RunningStats()
+		return self.stats[(label, feature)]
+
+	def labels(self):
+		return sorted(set(label for (label, feature) in self.stats))
+
+	def update(self, block):
+		"""Adds a tagged columnar block: a dictionary of field name to array, including the label."""
+		if block is None:
+			return
+		if self.features is None:
+			self.features = sorted(f for (f, column) in block.items()
+				if f != self.label_key and numpy.asarray(column).dtype.kind in 'iuf')
+		(labels, label_of) = numpy.unique(block[self.label_key], return_inverse=True)
+		for (i, label) in enumerate(labels.tolist()):
+			rows = label_of == i
+			for feature in self.features:
+				self.get(label, feature).add(block[feature][rows])
+
+	def merge(self, other):
+		"""Folds another LabelStats into this one."""
+		if self.features is None:
+			self.features = other.features
+		for ((label, feature), stats) in other.stats.items():
+			self.get(label, feature).merge(stats)
+		return self
+
+	def summary(self, quantiles=QUANTILES):
+		"""Returns {label: {feature: summary dictionary}}."""
+		result = {}
+		for ((label, feature), stats) in self.stats.items():
+			result.setdefault(label, {})[feature] = stats.summary(quantiles)
+		return result
+
+	def format_report(self):
+		lines = ['%-8s %-16s %8s %14s %14s %14s' % ('label', 'feature', 'count', 'mean', 'std', 'median')]
+		for label in self.labels():
+			for feature in self.features or []:
+				s = self.get(label, feature)
+				if s.count:
+					lines.append('%-8s %-16s %8d %14.6g %14.6g %14.6g' % (label, feature, s.count, s.mean, s.std(), s.quantile(0.5)))
+		return '\n'.join(lines)
+
+	def to_dict(self):
+		"""Returns the state as plain, JSON-safe values, for storing with a session."""
+		stats = {}
+		for ((label, feature), s) in self.stats.items():
+			stats.setdefault(label, {})[feature] = s.to_dict()
+		return {'features':self.features, 'label_key':self.label_key, 'stats':stats}
+
+	@classmethod
+	def from_dict(cls, d):
+		features = [str(f) for f in d['features']] if d['features'] is not None else None
+		label_stats = cls(features, str(d['label_key']))
+		for (label, by_feature) in d['stats'].items():
+			for (feature, s) in by_feature.items():
+				label_stats.stats[(str(label), str(feature))] = RunningStats.from_dict(s)
+		return label_stats
+
+
+def combine(dicts):
+	"""Merges the to_dict() forms of several LabelStats (e.g. from session footers) into one LabelStats."""
+	combined = LabelStats()
+	for d in dicts:
+		combined.merge(LabelStats.from_dict(d))
+	return combined
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+session_io.py
+
+Reading and writing training session files.
+
+Sessions used to be written in one go at exit, as a single pickled dictionary
+(.p). The trainer now streams them instead (.ps): a header pickle, then one
+pickled chunk of records at a time, with metadata and footer dictionaries
+along the way. Metadata that grows as the session goes on, such as the stimulus
+schedule, is written one {'entries':...} item at a time and read back as a list. A chunk is either a list of record tuples or, when the records
+arrive as columnar blocks, a {'columns':...} dictionary of field name to array. Pending
+records are written out as a chunk once there are enough of them or once the
+fsync interval has passed, and the file is fsynced on that interval, so a crash
+loses at most the last interval's records and a partially written file can
+still be read.
+
+Sessions can also be converted to a columnar layout (.cols): a directory
+holding meta.json and one .npy file per field, which numpy can memory map
+without deserializing anything. Label strings are stored as fixed-width bytes.
+
+For long term storage there is a compressed archive format (.pz): each column
+is cut into fixed-size chunks of records and every chunk is compressed on its
+own (zlib by default, or bz2, or lzma where the interpreter has it). The file
+ends with an index of where each compressed chunk lives along with per chunk
+value ranges, so SessionArchive can decompress only the chunks, columns or
+time ranges it is asked for, and summarize a session without inflating it.
+
+load_session reads any of these into the same dictionary the analysis
+code expects: start_time, user, session_number and either data (plus fields
+when the records are stored as tuples) or columns, a dictionary of field
+name to array.
+
+To convert existing sessions:
+	python session_io.py columns output/michael_1.p [...]
+	python session_io.py archive output/michael_1.p [...]
+"""
+
+import os
+import sys
+import bz2
+import json
+import time
+import zlib
+import struct
+import pickle
+import numpy
+
+(PICKLE_EXTENSION, STREAM_EXTENSION, COLUMNS_EXTENSION, ARCHIVE_EXTENSION) = ('.p', '.ps', '.cols', '.pz')
+SESSION_EXTENSIONS = (PICKLE_EXTENSION, STREAM_EXTENSION, COLUMNS_EXTENSION, ARCHIVE_EXTENSION)
+# when one session exists in several formats, the first one listed here is used
+PREFERRED_EXTENSIONS = (COLUMNS_EXTENSION, ARCHIVE_EXTENSION, STREAM_EXTENSION, PICKLE_EXTENSION)
+STREAM_FORMAT = 'braintrain-session-stream'
+STREAM_VERSION = 1
+COLUMNS_FORMAT = 'braintrain-session-columns'
+COLUMNS_VERSION = 1
+COLUMNS_METADATA_FILENAME = 'meta.json'
+ARCHIVE_MAGIC = 'BTSARCH1'
+ARCHIVE_TRAILER = struct.Struct('<QQ8s') # index offset, index length, magic
+ARCHIVE_CHUNK_SIZE = 1024 # records per compressed chunk
+ARCHIVE_CODECS = {
+	'zlib':(lambda data: zlib.compress(data, 9), zlib.decompress),
+	'bz2':(lambda data: bz2.compress(data, 9), bz2.decompress)}
+try:
+	import lzma
+	ARCHIVE_CODECS['lzma'] = (lzma.compress, lzma.decompress)
+except ImportError:
+	# lzma only ships with Python 3; zlib and bz2 are always there
+	pass
+CHUNK_SIZE = 64 # records per chunk
+FSYNC_INTERVAL = 5.0 # seconds
+
+
+class SessionWriter(object):
+	"""
+	Appends tagged records to a streaming session file as they are produced.
+
+	Records are buffered until chunk_size of them are pending, or until
+	fsync_interval seconds have passed since they were last written out, and
+	then written as one chunk; the file is fsynced every fsync_interval seconds,
+	and whenever metadata is recorded. The
+	writer can be called directly with a list of records or a columnar block (a
+	dictionary of field name to array, as tagged by the trainer), so it can stand
+	in for the trainer's data output function. A session is written either as
+	rows or as blocks, not both. close() writes the footer.
+	"""
+
+	def __init__(self, filename, user, session_number, fields, chunk_size=CHUNK_SIZE, fsync_interval=FSYNC_INTERVAL):
+		self.filename = filename
+		self.fields = tuple(fields)
+		self.chunk_size = chunk_size
+		self.fsync_interval = fsync_interval
+		self.metadata = {'user':user, 'session_number':session_number, 'start_time':None}
+		self.kind = None # 'rows' or 'columns', once the first records arrive
+		self.pending = []
+		self.pending_blocks = []
+		self.pending_count = 0
+		self.record_count = 0
+		self.last_fsync = self.last_flush = time.time()
+		self.file = open(filename, 'wb')
+		header = dict(self.metadata, format=STREAM_FORMAT, version=STREAM_VERSION, fields=self.fields)
+		self._write(header)
+		self.sync()
+
+	def _write(self, obj):
+		pickle.dump(obj, self.file, pickle.HIGHEST_PROTOCOL)
+
+	def set_metadata(self, **metadata):
+		"""Records session metadata (e.g. start_time) right away, ahead of the footer."""
+		self.metadata.update(metadata)
+		# pending records go out first, so they are synced along with it
+		self.flush()
+		self._write({'metadata':metadata})
+		self.sync()
+
+	def add_metadata_entry(self, key, entry):
+		"""
+		Appends one entry to a list in the session metadata (e.g. the stimulus
+		schedule). Only the new entry is written, and readers collect them into
+		a list under :key.
+		"""
+		self.flush()
+		self._write({'entries':{key:entry}})
+		self.sync()
+
+	def set_start_time(self, start_time):
+		self.set_metadata(start_time=start_time)
+
+	def append(self, records):
+		"""Queues records (objects with an as_tuple method, or tuples) or a columnar block for writing."""
+		if isinstance(records, dict):
+			self._append_block(records)
+			return
+		if not records:
+			return
+		if self.kind == 'columns':
+			raise ValueError('cannot mix records and columnar blocks in one session')
+		self.kind = 'rows'
+		self.pending.extend(r if isinstance(r, tuple) else r.as_tuple() for r in records)
+		self.pending_count = len(self.pending)
+		self._flush_if_due()
+
+	def _append_block(self, block):
+		if set(block) != set(self.fields):
+			raise ValueError('block fields %s do not match the session fields' % sorted(block))
+		if self.kind == 'rows':
+			raise ValueError('cannot mix records and columnar blocks in one session')
+		self.kind = 'columns'
+		self.pending_blocks.append(block)
+		self.pending_count += len(block.values()[0])
+		self._flush_if_due()
+
+	def _flush_if_due(self):
+		# a slow headset may never fill a chunk, so the interval also forces one out
+		if self.pending_count >= self.chunk_size or time.time() - self.last_flush >= self.fsync_interval:
+			self.flush()
+
+	__call__ = append
+
+	def flush(self):
+		"""Writes out any pending records, fsyncing if the interval has passed."""
+		if self.pending:
+			self._write(self.pending)
+			self.pending = []
+		elif self.pending_blocks:
+			chunk = dict((f, numpy.concatenate([b[f] for b in self.pending_blocks])) for f in self.fields)
+			self._write({'columns':chunk})
+			self.pending_blocks = []
+		self.record_count += self.pending_count
+		self.pending_count = 0
+		self.last_flush = time.time()
+		self.file.flush()
+		if time.time() - self.last_fsync >= self.fsync_interval:
+			self.sync()
+
+	def sync(self):
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.last_fsync = time.time()
+
+	def close(self, **metadata):
+		"""Writes any pending records and the footer, then closes the file."""
+		if self.file.closed:
+			return
+		self.flush()
+		self.metadata.update(metadata)
+		self._write({'footer':dict(self.metadata, record_count=self.record_count, end_time=time.time())})
+		self.sync()
+		self.file.close()
+
+
+def _stream_objects(f):
+	"""
+	Yields the pickled objects following the header of an open session stream,
+	up to the end of the file or the first one that can't be loaded.
+	"""
+	while True:
+		try:
+			obj = pickle.load(f)
+		except EOFError:
+			return
+		except Exception:
+			# a chunk only partly written when the trainer died: a cut-short pickle
+			# can fail in just about any way (struct.error, TypeError, ImportError
+			# from a half-written class reference...)
+			return
+		yield obj
+
+
+def _read_stream_header(f, filename):
+	"""Reads the header of an open session stream into the start of its contents."""
+	header = pickle.load(f)
+	if not isinstance(header, dict) or header.get('format') != STREAM_FORMAT:
+		raise ValueError('%s is not a session stream' % filename)
+	return {'start_time':header['start_time'], 'user':header['user'],
+		'session_number':header['session_number'], 'fields':header['fields']}
+
+
+def _add_stream_metadata(contents, obj):
+	"""Folds a metadata, entries or footer object from a session stream into :contents."""
+	if 'metadata' in obj:
+		contents.update(obj['metadata'])
+	elif 'entries' in obj:
+		for (key, entry) in obj['entries'].items():
+			contents.setdefault(key, []).append(entry)
+	elif 'footer' in obj:
+		contents.update(obj['footer'])
+		contents['complete'] = True
+
+
+def read_stream(filename):
+	"""
+	Reads a streaming session file, stopping quietly at a truncated tail. The
+	result has a 'complete' key that is False if the footer was never written.
+	Sessions written as columnar blocks come back with columns rather than data.
+	"""
+	f = open(filename, 'rb')
+	try:
+		contents = _read_stream_header(f, filename)
+		contents.update(data=[], complete=False)
+		blocks = []
+		for obj in _stream_objects(f):
+			if isinstance(obj, list):
+				contents['data'].extend(obj)
+			elif 'columns' in obj:
+				blocks.append(obj['columns'])
+			else:
+				_add_stream_metadata(contents, obj)
+		if blocks:
+			fields = contents.pop('fields')
+			del contents['data']
+			contents['columns'] = dict((f, numpy.concatenate([b[f] for b in blocks])) for f in fields)
+		return contents
+	finally:
+		f.close()
+
+
+def _column_filename(directory, field):
+	return os.path.join(directory, '%s.npy' % field)
+
+
+def write_columns(contents, directory):
+	"""Writes loaded session contents out as a columnar session directory."""
+	columns = session_columns(contents)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	for (field, column) in columns.items():
+		numpy.save(_column_filename(directory, field), column)
+	metadata = dict((k, v) for (k, v) in contents.items() if k not in ('data', 'fields', 'columns'))
+	metadata.update(format=COLUMNS_FORMAT, version=COLUMNS_VERSION, fields=list(columns.keys()),
+		record_count=len(columns.values()[0]) if columns else 0)
+	# metadata goes last, so a directory without it is known to be incomplete
+	with open(os.path.join(directory, COLUMNS_METADATA_FILENAME), 'w') as f:
+		json.dump(metadata, f, indent=1)
+	return directory
+
+
+def read_columns(directory, mmap_mode='r'):
+	"""Opens a columnar session, memory mapping every column."""
+	with open(os.path.join(directory, COLUMNS_METADATA_FILENAME)) as f:
+		metadata = json.load(f)
+	if metadata.get('format') != COLUMNS_FORMAT:
+		raise ValueError('%s is not a columnar session' % directory)
+	contents = dict((str(k), v) for (k, v) in metadata.items() if k not in ('format', 'version', 'fields'))
+	contents['columns'] = dict((str(field), numpy.load(_column_filename(directory, field), mmap_mode=mmap_mode))
+		for field in metadata['fields'])
+	return contents
+
+
+def convert_to_columns(filename, directory=None):
+	"""Converts a .p or .ps session file to a .cols directory next to it (or at :directory)."""
+	if directory is None:
+		directory = os.path.splitext(filename)[0] + COLUMNS_EXTENSION
+	return write_columns(load_session(filename), directory)
+
+
+def _chunk_stats(column):
+	"""Returns what the archive index records about one chunk of a column."""
+	if column.dtype.kind in 'iuf':
+		return [column.min().item(), column.max().item()]
+	elif column.dtype.kind == 'S':
+		return sorted(set(column.tolist()))
+	return None
+
+
+def write_archive(contents, filename, chunk_size=ARCHIVE_CHUNK_SIZE, codec='zlib'):
+	"""Writes loaded session contents out as a compressed, chunked session archive."""
+	(compress, decompress) = ARCHIVE_CODECS[codec]
+	columns = session_columns(contents)
+	fields = sorted(columns.keys())
+	record_count = len(columns[fields[0]]) if fields else 0
+	chunks = []
+	tmp_filename = filename + '.tmp'
+	with open(tmp_filename, 'wb') as f:
+		f.write(ARCHIVE_MAGIC)
+		for start in xrange(0, record_count, chunk_size):
+			chunk = {'start':start, 'count':min(chunk_size, record_count - start), 'blobs':{}, 'stats':{}}
+			for field in fields:
+				part = numpy.ascontiguousarray(columns[field][start:start + chunk_size])
+				blob = compress(part.tostring())
+				chunk['blobs'][field] = [f.tell(), len(blob)]
+				chunk['stats'][field] = _chunk_stats(part)
+				f.write(blob)
+			chunks.append(chunk)
+		metadata = dict((k, v) for (k, v) in contents.items() if k not in ('data', 'fields', 'columns'))
+		index = zlib.compress(json.dumps({
+			'metadata':metadata, 'codec':codec, 'record_count':record_count,
+			'dtypes':dict((field, columns[field].dtype.str) for field in fields),
+			'chunks':chunks}))
+		index_offset = f.tell()
+		f.write(index)
+		# the trailer goes last, so a file without one is known to be incomplete
+		f.write(ARCHIVE_TRAILER.pack(index_offset, len(index), ARCHIVE_MAGIC))
+	os.rename(tmp_filename, filename)
+	return filename
+
+
+class SessionArchive(object):
+	"""
+	Random access to a compressed session archive. Opening one only reads its
+	index; columns are decompressed a chunk at a time as they are asked for.
+
+	Syntax: archive = SessionArchive('output/michael_1.pz')
+	        columns = archive.read(fields=['theta', 'label'])
+	        columns = archive.read_range(10.0, 20.0)
+	"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		self.file.seek(-ARCHIVE_TRAILER.size, os.SEEK_END)
+		(index_offset, index_length, magic) = ARCHIVE_TRAILER.unpack(self.file.read(ARCHIVE_TRAILER.size))
+		if magic != ARCHIVE_MAGIC:
+			raise ValueError('%s is not a session archive' % filename)
+		self.file.seek(index_offset)
+		index = json.loads(zlib.decompress(self.file.read(index_length)))
+		self.metadata = dict((str(k), v) for (k, v) in index['metadata'].items())
+		self.record_count = index['record_count']
+		self.dtypes = dict((str(field), numpy.dtype(str(dtype))) for (field, dtype) in index['dtypes'].items())
+		self.fields = sorted(self.dtypes.keys())
+		self.chunks = index['chunks']
+		self.decompress = ARCHIVE_CODECS[index['codec']][1]
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def read_chunk(self, chunk, field):
+		(offset, length) = self.chunks[chunk]['blobs'][field]
+		self.file.seek(offset)
+		return numpy.frombuffer(self.decompress(self.file.read(length)), dtype=self.dtypes[field])
+
+	def read(self, fields=None, chunks=None):
+		"""Decompresses :fields (default all) of :chunks (default all) into a dictionary of arrays."""
+		fields = self.fields if fields is None else fields
+		chunks = xrange(len(self.chunks)) if chunks is None else chunks
+		columns = {}
+		for field in fields:
+			parts = [self.read_chunk(c, field) for c in chunks]
+			columns[field] = numpy.concatenate(parts) if parts else numpy.array([], dtype=self.dtypes[field])
+		return columns
+
+	def chunks_overlapping(self, field, low, high):
+		"""Returns the chunks that may hold values of a numeric field in [low, high]."""
+		return [c for (c, chunk) in enumerate(self.chunks)
+			if chunk['stats'][field][0] <= high and chunk['stats'][field][1] >= low]
+
+	def chunks_containing(self, field, value):
+		"""Returns the chunks in which a string field takes the given value."""
+		return [c for (c, chunk) in enumerate(self.chunks) if value in chunk['stats'][field]]
+
+	def read_range(self, start_time, end_time, fields=None, time_field='time'):
+		"""Returns the records whose time is in [start_time, end_time), decompressing only the chunks they are in."""
+		fields = self.fields if fields is None else list(fields)
+		chunks = self.chunks_overlapping(time_field, start_time, end_time)
+		columns = self.read(set(fields) | set([time_field]), chunks)
+		times = columns[time_field]
+		keep = (times >= start_time) & (times < end_time)
+		return dict((field, columns[field][keep]) for field in fields)
+
+	def column_stats(self):
+		"""Combines the per chunk index entries: [min, max] for numeric fields, the values seen for string fields."""
+		stats = {}
+		for field in self.fields:
+			chunk_stats = [chunk['stats'][field] for chunk in self.chunks if chunk['stats'][field] is not None]
+			if not chunk_stats:
+				continue
+			if self.dtypes[field].kind == 'S':
+				stats[field] = sorted(set(str(v) for values in chunk_stats for v in values))
+			else:
+				stats[field] = [min(s[0] for s in chunk_stats), max(s[1] for s in chunk_stats)]
+		return stats
+
+
+def read_archive(filename):
+	"""Reads a whole session archive into the same dictionary read_columns returns."""
+	with SessionArchive(filename) as archive:
+		contents = dict(archive.metadata)
+		contents['columns'] = archive.read()
+	return contents
+
+
+def convert_to_archive(filename, archive_filename=None, codec='zlib'):
+	"""Converts a session in any other format to a .pz archive next to it (or at :archive_filename)."""
+	if archive_filename is None:
+		archive_filename = os.path.splitext(filename.rstrip(os.sep))[0] + ARCHIVE_EXTENSION
+	return write_archive(load_session(filename), archive_filename, codec=codec)
+
+
+def _slices(columns, chunk_size):
+	count = len(columns.values()[0]) if columns else 0
+	for start in xrange(0, count, chunk_size):
+		yield dict((field, column[start:start + chunk_size]) for (field, column) in columns.items())
+
+
+def _iter_stream_chunks(filename, chunk_size, fields, select):
+	f = open(filename, 'rb')
+	try:
+		metadata = _read_stream_header(f, filename)
+		stream_fields = metadata.pop('fields')
+		if select is not None and not select(metadata):
+			return
+		for obj in _stream_objects(f):
+			if isinstance(obj, list):
+				columns = session_columns({'fields':stream_fields, 'data':obj})
+			elif 'columns' in obj:
+				columns = obj['columns']
+			else:
+				_add_stream_metadata(metadata, obj)
+				continue
+			if fields is not None:
+				columns = dict((field, columns[field]) for field in fields)
+			for piece in _slices(columns, chunk_size):
+				yield (dict(metadata), piece)
+	finally:
+		f.close()
+
+
+def iter_session_chunks(filename, chunk_size=ARCHIVE_CHUNK_SIZE, fields=None, select=None):
+	"""
+	Yields (metadata, columns) for successive chunks of at most chunk_size records
+	of a session, with columns a dictionary of field name to array for :fields
+	(default all). Archives are decompressed one chunk at a time, streams are
+	read a pickled chunk at a time and columnar sessions are memory mapped, so
+	only the chunk in hand is ever in memory; single pickle (.p) sessions have
+	to be loaded whole first.
+
+	:select, if given, is called with the session's metadata before any records
+	are read, and the session is skipped unless it returns true. The metadata
+	comes from the stream header, archive index or meta.json, so skipping a
+	session costs next to nothing in every format but .p. A stream's metadata
+	gains the entries recorded along the way (start_time and so on) as they are
+	read.
+	"""
+	ext = os.path.splitext(filename.rstrip(os.sep))[1]
+	if ext == STREAM_EXTENSION:
+		for chunk in _iter_stream_chunks(filename, chunk_size, fields, select):
+			yield chunk
+		return
+	if ext == ARCHIVE_EXTENSION:
+		with SessionArchive(filename) as archive:
+			if select is not None and not select(archive.metadata):
+				return
+			for c in xrange(len(archive.chunks)):
+				for piece in _slices(archive.read(fields, [c]), chunk_size):
+					yield (archive.metadata, piece)
+		return
+	contents = load_session(filename)
+	metadata = dict((k, v) for (k, v) in contents.items() if k not in ('data', 'fields', 'columns'))
+	if select is not None and not select(metadata):
+		return
+	columns = session_columns(contents)
+	if fields is not None:
+		columns = dict((field, columns[field]) for field in fields)
+	for piece in _slices(columns, chunk_size):
+		yield (metadata, piece)
+
+
+def is_session_file(filename):
+	return os.path.splitext(filename.rstrip(os.sep))[1] in SESSION_EXTENSIONS
+
+
+def session_files(directory):
+	"""
+	Lists the session files in :directory, one per session: where a session has
+	been converted, only its most preferred format is listed.
+	"""
+	by_session = {}
+	for fn in os.listdir(directory):
+		(stem, ext) = os.path.splitext(fn)
+		if ext not in SESSION_EXTENSIONS:
+			continue
+		current = by_session.get(stem)
+		if current is None or PREFERRED_EXTENSIONS.index(ext) < PREFERRED_EXTENSIONS.index(os.path.splitext(current)[1]):
+			by_session[stem] = fn
+	return [os.path.join(directory, by_session[stem]) for stem in sorted(by_session)]
+
+
+def load_session(filename):
+	"""Loads a session file of any supported kind."""
+	ext = os.path.splitext(filename.rstrip(os.sep))[1]
+	if ext == STREAM_EXTENSION:
+		return read_stream(filename)
+	elif ext == PICKLE_EXTENSION:
+		return pickle.load(open(filename, 'rb'))
+	elif ext == COLUMNS_EXTENSION:
+		return read_columns(filename)
+	elif ext == ARCHIVE_EXTENSION:
+		return read_archive(filename)
+	raise ValueError('unrecognised session file %s' % filename)
+
+
+def session_fields(contents):
+	"""Returns the field names of a loaded session's records."""
+	if 'columns' in contents:
+		return sorted(contents['columns'].keys())
+	if 'fields' in contents:
+		return list(contents['fields'])
+	return sorted(contents['data'][0].keys()) if contents['data'] else []
+
+
+def session_records(contents):
+	"""Returns a loaded session's records as dictionaries, whichever way they were stored."""
+	if 'columns' in contents:
+		fields = session_fields(contents)
+		return [dict(zip(fields, row)) for row in zip(*[contents['columns'][f].tolist() for f in fields])]
+	if 'fields' in contents:
+		fields = contents['fields']
+		return [dict(zip(fields, row)) for row in contents['data']]
+	return contents['data']
+
+
+def session_columns(contents):
+	"""Returns a loaded session's records as a dictionary of field name to array."""
+	if 'columns' in contents:
+		return contents['columns']
+	fields = session_fields(contents)
+	if 'fields' in contents:
+		values = zip(*contents['data']) if contents['data'] else [()] * len(fields)
+	else:
+		values = [[r[f] for r in contents['data']] for f in fields]
+	columns = {}
+	for (field, column) in zip(fields, values):
+		column = numpy.array(column)
+		if column.dtype.kind == 'O':
+			raise ValueError('field %s does not have a single scalar type' % field)
+		columns[field] = column
+	return columns
+
+
+def main(args):
+	converters = {'columns':convert_to_columns, 'archive':convert_to_archive}
+	if len(args) < 2 or args[0] not in converters:
+		print 'usage: python session_io.py columns|archive SESSION_FILE [SESSION_FILE ...]'
+		return 1
+	for fn in args[1:]:
+		print '%s -> %s' % (fn, converters[args[0]](fn))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
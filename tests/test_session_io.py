@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+test_session_io.py
+
+Run from the repository root with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import session_io
+
+FIELDS = ('theta', 'time', 'label')
+
+
+def _block(i):
+	return {'theta':numpy.array([i], dtype=numpy.int64), 'time':numpy.array([float(i)]), 'label':numpy.array(['Red'])}
+
+
+class SessionWriterTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.filename = os.path.join(self.directory, 'user_1' + session_io.STREAM_EXTENSION)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_records_reach_disk_while_metadata_is_set_more_often_than_the_interval(self):
+		writer = session_io.SessionWriter(self.filename, 'user', 1, FIELDS, chunk_size=64, fsync_interval=0.05)
+		schedule = []
+		for i in range(30):
+			writer.append(_block(i))
+			if i % 3 == 0:
+				schedule.append((i, 1, 'Red'))
+				writer.set_metadata(stimulus_schedule=list(schedule))
+			time.sleep(0.01)
+		# never closed, as if the trainer had crashed
+		contents = session_io.load_session(self.filename)
+		self.assertFalse(contents['complete'])
+		columns = session_io.session_columns(contents)
+		self.assertGreaterEqual(len(columns['time']), 27)
+		self.assertEqual(columns['theta'].tolist(), range(len(columns['theta'])))
+
+	def test_records_reach_disk_on_the_interval_without_metadata(self):
+		writer = session_io.SessionWriter(self.filename, 'user', 1, FIELDS, chunk_size=64, fsync_interval=0.05)
+		for i in range(20):
+			writer.append(_block(i))
+			time.sleep(0.01)
+		columns = session_io.session_columns(session_io.load_session(self.filename))
+		self.assertGreaterEqual(len(columns['time']), 15)
+
+	def test_metadata_entries_are_collected_into_a_list(self):
+		writer = session_io.SessionWriter(self.filename, 'user', 1, FIELDS)
+		for i in range(3):
+			writer.add_metadata_entry('stimulus_schedule', (4.0 * i, 4.0, 'Red'))
+			writer.append(_block(i))
+		self.assertEqual(session_io.load_session(self.filename)['stimulus_schedule'],
+			[(0.0, 4.0, 'Red'), (4.0, 4.0, 'Red'), (8.0, 4.0, 'Red')])
+		writer.close()
+		metadata = list(session_io.iter_session_chunks(self.filename))[-1][0]
+		self.assertEqual(len(metadata['stimulus_schedule']), 3)
+
+	def test_truncated_stream_still_loads(self):
+		writer = session_io.SessionWriter(self.filename, 'user', 1, FIELDS, chunk_size=4)
+		for i in range(20):
+			writer.append(_block(i))
+		writer.close()
+		with open(self.filename, 'rb') as f:
+			data = f.read()
+		for cut in (len(data) - 1, len(data) // 2, len(data) // 3):
+			with open(self.filename, 'wb') as f:
+				f.write(data[:cut])
+			contents = session_io.load_session(self.filename)
+			self.assertFalse(contents['complete'])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+thinkgear_sim.py
+
+A stand-in for the ThinkGear connector, for exercising eeg.MindStream without a
+headset. It accepts connections, reads the JSON config message, sends a few
+NULL_DATA frames the way the connector does while the headset warms up, and
+then streams eSense/eegPower frames (plus rawEeg frames if the client asked
+for raw output). The frames either replay recorded sessions from output/
+or are generated randomly, at any multiple of the headset's real rate.
+
+usage:
+	python thinkgear_sim.py [--port 13854] [--speed 10] [--replay output/michael_1.p ...]
+	python thinkgear_sim.py --measure 10 --speed 1000
+
+To run the trainer headlessly against it, start the simulator on the default
+port and run colortrainer.py with SDL_VIDEODRIVER=dummy.
+"""
+
+import os
+import json
+import time
+import random
+import optparse
+from socket import *
+from threading import Thread, Event, Lock
+
+import eeg
+import session_io
+
+SAMPLE_RATE = 1 # eSense/eegPower frames per second from a real headset
+WARMUP_FRAMES = 3 # NULL_DATA frames sent before any real data
+BLINK_PROBABILITY = 0.05
+TICK = 0.02 # seconds between batches of frames
+DEFAULT_REPLAY_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'output')
+
+
+def _frame(message):
+	return json.dumps(message) + eeg.HEADSET_JSON_SEPARATOR
+
+
+def _sample_message(values):
+	"""Builds a connector message out of values in brain_parameters order."""
+	d = dict(zip(eeg.brain_parameters, values))
+	return {
+		eeg.eSense: {eeg.attention:d[eeg.attention], eeg.meditation:d[eeg.meditation]},
+		eeg.eegPower: dict((p, d[p]) for p in eeg.brain_parameters[:8]),
+		eeg.poorSignalLevel: d[eeg.poorSignalLevel]}
+
+
+def load_recorded_values(filenames):
+	"""Returns the brain parameter values of every record in the given session files."""
+	values = []
+	for fn in filenames:
+		records = session_io.session_records(session_io.load_session(fn))
+		values.extend(tuple(r[p] for p in eeg.brain_parameters) for r in records)
+	return values
+
+
+def recorded_session_files(directory=DEFAULT_REPLAY_DIRECTORY):
+	return session_io.session_files(directory)
+
+
+def recorded_source(filenames):
+	"""Endlessly cycles through the frames of the recorded sessions."""
+	frames = [_frame(_sample_message(v)) for v in load_recorded_values(filenames)]
+	if not frames:
+		raise ValueError('no records found in %s' % ', '.join(filenames))
+	while True:
+		for f in frames:
+			yield f
+
+
+def synthetic_source():
+	"""Endlessly generates plausible random frames, with the occasional blink."""
+	while True:
+		values = tuple(random.randint(1000, 300000) for p in eeg.brain_parameters[:8]) + (0, random.randint(0, 100), random.randint(0, 100))
+		yield _frame(_sample_message(values))
+		if random.random() < BLINK_PROBABILITY:
+			yield _frame({'blinkStrength':random.randint(1, 255)})
+
+
+def _raw_frames(n):
+	return ''.join(_frame({eeg.rawEeg:random.randint(-2048, 2047)}) for i in xrange(n))
+
+
+class ThinkGearSimulator(object):
+	"""
+	Serves simulated connector data on (host, port) from a background thread.
+
+	:source is a function returning an iterator of frames, e.g. synthetic_source
+	:speed multiplies the headset's real rate; 0 sends as fast as the socket allows
+	"""
+
+	def __init__(self, host=eeg.HOST, port=eeg.PORT, source=synthetic_source, speed=1.0, warmup_frames=WARMUP_FRAMES):
+		self.source = source
+		self.speed = speed
+		self.warmup_frames = warmup_frames
+		self.sent = 0
+		self.sent_lock = Lock()
+		self.shutdown_flag = Event()
+		self.server = socket(AF_INET, SOCK_STREAM)
+		self.server.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+		self.server.bind((host, port))
+		self.server.listen(5)
+		self.server.settimeout(eeg.ASYNC_POLL_INTERVAL)
+		(self.host, self.port) = self.server.getsockname()
+		self.server_thread = Thread(target=self._serve)
+		self.server_thread.daemon = True
+
+	def start(self):
+		self.server_thread.start()
+		return self
+
+	def stop(self):
+		self.shutdown_flag.set()
+		self.server_thread.join()
+		self.server.close()
+
+	def _serve(self):
+		while not self.shutdown_flag.isSet():
+			try:
+				(conn, addr) = self.server.accept()
+			except timeout:
+				continue
+			t = Thread(target=self._stream, args=(conn,))
+			t.daemon = True
+			t.start()
+
+	def _stream(self, conn):
+		conn.settimeout(None)
+		try:
+			config = json.loads(conn.recv(1024) or '{}')
+		except ValueError:
+			config = {}
+		raw = config.get('enableRawOutput', False)
+		frames = self.source()
+		try:
+			conn.sendall(_frame(eeg.NULL_DATA) * self.warmup_frames)
+			start = time.time()
+			due = 0
+			while not self.shutdown_flag.isSet():
+				if self.speed > 0:
+					# send whatever is due since the start, then sleep until the next tick
+					due_now = int((time.time() - start) * SAMPLE_RATE * self.speed)
+					n = due_now - due
+					due = due_now
+					if n == 0:
+						time.sleep(TICK)
+						continue
+				else:
+					n = 100
+				batch = ''.join(frames.next() for i in xrange(n))
+				if raw:
+					batch += _raw_frames(n * eeg.RAW_SAMPLE_RATE / SAMPLE_RATE)
+				conn.sendall(batch)
+				with self.sent_lock:
+					self.sent += n
+		except error:
+			# client went away
+			pass
+		finally:
+			conn.close()
+
+
+def measure_ingest(seconds, speed, source=synthetic_source, **stream_args):
+	"""
+	Runs a MindStream against a simulator for the given number of seconds, draining
+	it continuously, and returns (frames sent, samples received, queue stats).
+	"""
+	sim = ThinkGearSimulator(port=0, source=source, speed=speed).start()
+	ms = eeg.MindStream(sim.host, sim.port, **stream_args)
+	received = 0
+	start = time.time()
+	while time.time() - start < seconds:
+		block = ms.drainColumns()
+		if block is not None:
+			received += len(block[eeg.BLOCK_TIME])
+		time.sleep(TICK)
+	ms.shutdown()
+	sim.stop()
+	block = ms.drainColumns()
+	if block is not None:
+		received += len(block[eeg.BLOCK_TIME])
+	return (sim.sent, received, ms.getQueueStats())
+
+
+def main():
+	parser = optparse.OptionParser(usage='%prog [options]')
+	parser.add_option('--host', default=eeg.HOST)
+	parser.add_option('--port', type='int', default=eeg.PORT)
+	parser.add_option('--speed', type='float', default=1.0, help='multiple of the real headset rate, 0 for unthrottled')
+	parser.add_option('--replay', action='append', metavar='FILE', help='session file to replay (repeatable)')
+	parser.add_option('--replay-all', action='store_true', help='replay every session in output/')
+	parser.add_option('--synthetic', action='store_true', help='generate random data instead of replaying sessions')
+	parser.add_option('--measure', type='float', metavar='SECONDS', help='load test a MindStream against the simulator and exit')
+	(opts, args) = parser.parse_args()
+
+	if opts.synthetic or not (opts.replay or opts.replay_all):
+		source = synthetic_source
+	else:
+		files = opts.replay or recorded_session_files()
+		source = lambda: recorded_source(files)
+
+	if opts.measure:
+		(sent, received, stats) = measure_ingest(opts.measure, opts.speed, source)
+		print 'sent %d frames, received %d samples in %.1fs (%.0f samples/s)' % (sent, received, opts.measure, received / opts.measure)
+		print 'queue stats: %s' % stats
+		return
+
+	sim = ThinkGearSimulator(opts.host, opts.port, source, opts.speed).start()
+	print 'simulating ThinkGear connector on %s:%d at %gx' % (sim.host, sim.port, opts.speed)
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		sim.stop()
+
+if __name__ == '__main__':
+	main()